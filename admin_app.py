@@ -1,17 +1,26 @@
 from __future__ import annotations
 
+import mimetypes
+import os
+import time
 from pathlib import Path
+from typing import Annotated
 
-from fastapi import FastAPI, Request, Form, HTTPException
+from fastapi import FastAPI, Request, Form, HTTPException, Depends
 from fastapi.responses import RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import func, case, text, update, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only, raiseload
+from starlette.datastructures import Headers
 from starlette.status import HTTP_302_FOUND
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, field_validator
 from dotenv import load_dotenv  # ⬅ НОВОЕ: подхватываем .env
 
-from db import SessionLocal, Base, engine
-from models import Invoice, Proxy, Setting
+from db import Base, engine, get_async_sessionmaker, insert_for_dialect
+from models import INVOICE_STATUSES, Invoice, Proxy, Setting
 
 # -------------------------------------------------------------
 # ЗАГРУЗКА .env (ключи, конфиги и т.п.)
@@ -34,9 +43,97 @@ app = FastAPI(title="Aideon Agent Admin")
 # Создаём таблицы, если их нет
 Base.metadata.create_all(bind=engine)
 
-# Подключаем статику и шаблоны
-app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
-templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
+# create_all не добавляет колонки в уже существующие таблицы — старым
+# базам доливаем proxies.address (CLI manage_proxies.py) вручную.
+# IF NOT EXISTS для колонок нет, поэтому просто глушим ошибку повтора.
+try:
+    with engine.begin() as _conn:
+        _conn.execute(text("ALTER TABLE proxies ADD COLUMN address VARCHAR(512)"))
+except Exception:
+    pass
+
+# create_all не добавляет индексы в уже существующие таблицы (старые базы
+# создавались до index=True на колонках) — досоздаём горячие индексы руками:
+# фильтры дашборда по status, поиск колбэка по invoice_id, чтение настроек по key.
+with engine.begin() as _conn:
+    # составной (status, created_at) покрывает и фильтр по статусу,
+    # и очередь агента «ORDER BY created_at LIMIT n» без сортировки;
+    # одиночный ix_invoices_status им перекрыт — убираем
+    _conn.execute(text("DROP INDEX IF EXISTS ix_invoices_status"))
+    _conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_invoices_status_created_at"
+        " ON invoices (status, created_at)"
+    ))
+    _conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_proxies_active_lastused"
+        " ON proxies (is_active, last_used_at)"
+    ))
+    # частичный индекс по «живым» статусам — только строки, которые
+    # реально сканируют воркеры (исторические processed не раздувают его)
+    _conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_invoices_status_active"
+        " ON invoices (status)"
+        " WHERE status IN ('queued', 'processing', 'waiting_captcha')"
+    ))
+    _conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_invoices_invoice_id ON invoices (invoice_id)"
+    ))
+    _conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_settings_key ON settings (key)"))
+    _conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_proxies_address ON proxies (address)"
+    ))
+
+# Подключаем статику и шаблоны.
+# Скомпилированные шаблоны кладём на диск, чтобы Jinja2 не перепарсивала
+# их на каждый рестарт/воркер (парсинг — заметная часть TTFB дашборда).
+JINJA_CACHE_DIR = BASE_DIR / ".jinja_cache"
+JINJA_CACHE_DIR.mkdir(exist_ok=True)
+
+class CachedStaticFiles(StaticFiles):
+    """
+    Статика админки: долгий immutable-кэш + отдача предсжатых соседей.
+
+    Ассеты меняются только с деплоем, поэтому браузеру можно разрешить
+    кэшировать их на год. Если рядом с файлом лежит .br/.gz-версия
+    (генерится на этапе сборки: brotli -q 11 / gzip -9), отдаём её —
+    сжатие не тратит CPU на каждый хит.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+
+        response = None
+        for suffix, encoding in ((".br", "br"), (".gz", "gzip")):
+            if encoding not in accept_encoding:
+                continue
+            compressed = str(full_path) + suffix
+            try:
+                compressed_stat = os.stat(compressed)
+            except OSError:
+                continue
+            response = super().file_response(
+                compressed, compressed_stat, scope, status_code
+            )
+            # Content-Type — от исходного файла, а не от .br/.gz
+            media_type, _ = mimetypes.guess_type(str(full_path))
+            if media_type:
+                response.headers["Content-Type"] = media_type
+            response.headers["Content-Encoding"] = encoding
+            response.headers["Vary"] = "Accept-Encoding"
+            break
+
+        if response is None:
+            response = super().file_response(full_path, stat_result, scope, status_code)
+
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+app.mount("/static", CachedStaticFiles(directory=str(STATIC_DIR)), name="static")
+templates = Jinja2Templates(
+    directory=str(TEMPLATES_DIR),
+    bytecode_cache=FileSystemBytecodeCache(str(JINJA_CACHE_DIR)),
+)
 
 
 # -------------------------------------------------------------
@@ -49,21 +146,108 @@ SESSION_KEYS = ["SESSION_STATUS", "SESSION_MESSAGE", "SESSION_UPDATED_AT"]
 WORKER_AGENT_KEY = "AGENT_WORKER_ENABLED"
 WORKER_PRMONEY_KEY = "PRMONEY_WORKER_ENABLED"
 
+# Размер страницы списка инвойсов
+INVOICES_PAGE_SIZE = 100
+
+
+# -------------------------------------------------------------
+# КЭШ ДАШБОРДА
+# -------------------------------------------------------------
+# Дашборд опрашивается браузером каждые несколько секунд, а данные
+# меняются редко — держим агрегат в памяти процесса с коротким TTL,
+# чтобы не ходить в БД на каждый рефреш. POST-хендлеры сбрасывают кэш.
+_DASH_TTL_SECONDS = 3.0
+_dash_cache: dict[str, tuple[float, dict]] = {}
+
+
+def _dash_cache_get(key: str) -> dict | None:
+    entry = _dash_cache.get(key)
+    if not entry:
+        return None
+    ts, value = entry
+    if time.monotonic() - ts > _DASH_TTL_SECONDS:
+        _dash_cache.pop(key, None)
+        return None
+    return value
+
+
+def _dash_cache_put(key: str, value: dict) -> None:
+    _dash_cache[key] = (time.monotonic(), value)
+
+
+def _dash_cache_invalidate() -> None:
+    _dash_cache.clear()
+
+
+# Async-движок создаётся только здесь: остальным потребителям db.py
+# (агент, воркеры, CLI) драйверы aiosqlite/asyncpg не нужны.
+AsyncSessionLocal = get_async_sessionmaker()
+
+
+async def get_db():
+    """Request-scoped async-сессия БД (FastAPI dependency)."""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def _fast_count_estimate(db: AsyncSession, table: str) -> int | None:
+    """
+    Быстрая оценка числа строк для виджетов дашборда.
+
+    На PostgreSQL точный COUNT(*) — это полный скан таблицы, а для
+    виджета «всего инвойсов» достаточно оценки планировщика из
+    pg_class.reltuples (O(1) по каталогу). На SQLite и прочих движках
+    возвращаем None — вызывающий код сам сделает обычный COUNT.
+    """
+    if engine.dialect.name != "postgresql":
+        return None
+    result = await db.execute(
+        text("SELECT reltuples::bigint FROM pg_catalog.pg_class WHERE relname = :t"),
+        {"t": table},
+    )
+    est = result.scalar()
+    # reltuples = -1 (или 0 до первого ANALYZE) → оценки нет
+    if est is None or est < 0:
+        return None
+    return int(est)
+
+
+async def _db_get_setting(db: AsyncSession, key: str) -> str:
+    result = await db.execute(
+        select(Setting.value).where(Setting.key == key).limit(1)
+    )
+    value = result.scalar_one_or_none()
+    return value or ""
+
+
+async def _db_get_settings(db: AsyncSession, keys: list[str]) -> dict[str, str]:
+    """Читает сразу несколько настроек одним IN-запросом."""
+    result = await db.execute(
+        select(Setting.key, Setting.value).where(Setting.key.in_(keys))
+    )
+    return {k: (v or "") for k, v in result.all()}
+
 
-def _db_get_setting(db, key: str) -> str:
-    s = db.query(Setting).filter(Setting.key == key).first()
-    return s.value if s else ""
+async def _db_set_settings(db: AsyncSession, mapping: dict[str, str]) -> None:
+    """
+    Апсерт настроек одним INSERT ... ON CONFLICT(key) DO UPDATE
+    (вместо SELECT + INSERT/UPDATE на каждый ключ).
+    """
+    if not mapping:
+        return
+    insert_fn = insert_for_dialect()
+    stmt = insert_fn(Setting)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["key"],
+        set_={"value": stmt.excluded.value},
+    )
+    await db.execute(stmt, [{"key": k, "value": v} for k, v in mapping.items()])
+    await db.commit()
 
 
-def _db_set_setting(db, key: str, value: str) -> None:
+async def _db_set_setting(db: AsyncSession, key: str, value: str) -> None:
     """Универсальная запись / создание настройки."""
-    row = db.query(Setting).filter(Setting.key == key).first()
-    if not row:
-        row = Setting(key=key, value=value)
-        db.add(row)
-    else:
-        row.value = value
-    db.commit()
+    await _db_set_settings(db, {key: value})
 
 
 # -------------------------------------------------------------
@@ -78,75 +262,121 @@ def root():
 # DASHBOARD
 # -------------------------------------------------------------
 @app.get("/admin", name="admin_dashboard")
-def admin_dashboard(request: Request):
-    db = SessionLocal()
-    try:
-        total = db.query(Invoice).count()
-        queued = db.query(Invoice).filter(Invoice.status == "queued").count()
-        processing = db.query(Invoice).filter(Invoice.status == "processing").count()
-        waiting = db.query(Invoice).filter(Invoice.status == "waiting_captcha").count()
-        error = db.query(Invoice).filter(Invoice.status == "error").count()
-
-        proxies = db.query(Proxy).count()
-
-        # статусы сессии агента (обновляются из agent.py)
-        session_status = _db_get_setting(db, "SESSION_STATUS") or "unknown"
-        session_message = _db_get_setting(db, "SESSION_MESSAGE") or ""
-        session_updated_at = _db_get_setting(db, "SESSION_UPDATED_AT") or ""
-
-        # флаги воркеров (1 / 0)
-        agent_worker_enabled = (_db_get_setting(db, WORKER_AGENT_KEY) == "1")
-        prmoney_worker_enabled = (_db_get_setting(db, WORKER_PRMONEY_KEY) == "1")
-
-        return templates.TemplateResponse(
-            "admin/dashboard.html",
-            {
-                "request": request,
-                "active_page": "dashboard",
-                "total": total,
-                "queued": queued,
-                "processing": processing,
-                "waiting": waiting,
-                "error": error,
-                "proxies": proxies,
-                "session_status": session_status,
-                "session_message": session_message,
-                "session_updated_at": session_updated_at,
-                # новые поля для управления воркерами
-                "agent_worker_enabled": agent_worker_enabled,
-                "prmoney_worker_enabled": prmoney_worker_enabled,
-            },
+async def admin_dashboard(request: Request, db: AsyncSession = Depends(get_db)):
+    data = _dash_cache_get("dash")
+    if data is None:
+        # Все счётчики по инвойсам — одним агрегатным запросом вместо пяти COUNT
+        result = await db.execute(
+            select(
+                func.count(Invoice.id),
+                func.sum(case((Invoice.status == "queued", 1), else_=0)),
+                func.sum(case((Invoice.status == "processing", 1), else_=0)),
+                func.sum(case((Invoice.status == "waiting_captcha", 1), else_=0)),
+                func.sum(case((Invoice.status == "error", 1), else_=0)),
+            )
         )
-    finally:
-        db.close()
+        total, queued, processing, waiting, error = result.one()
+        queued, processing, waiting, error = (
+            queued or 0, processing or 0, waiting or 0, error or 0,
+        )
+
+        # Для «тотальных» виджетов точность не нужна — на Postgres берём
+        # оценку планировщика вместо полного COUNT(*)
+        total_estimate = await _fast_count_estimate(db, "invoices")
+        if total_estimate is not None:
+            total = total_estimate
+
+        proxies = await _fast_count_estimate(db, "proxies")
+        if proxies is None:
+            proxies = (
+                await db.execute(select(func.count(Proxy.id)))
+            ).scalar_one()
+
+        # настройки сессии и флаги воркеров — одним IN-запросом
+        setting_keys = SESSION_KEYS + [WORKER_AGENT_KEY, WORKER_PRMONEY_KEY]
+        settings = await _db_get_settings(db, setting_keys)
+
+        data = {
+            "total": total,
+            "queued": queued,
+            "processing": processing,
+            "waiting": waiting,
+            "error": error,
+            "proxies": proxies,
+            # статусы сессии агента (обновляются из agent.py)
+            "session_status": settings.get("SESSION_STATUS") or "unknown",
+            "session_message": settings.get("SESSION_MESSAGE") or "",
+            "session_updated_at": settings.get("SESSION_UPDATED_AT") or "",
+            # флаги воркеров (1 / 0)
+            "agent_worker_enabled": settings.get(WORKER_AGENT_KEY) == "1",
+            "prmoney_worker_enabled": settings.get(WORKER_PRMONEY_KEY) == "1",
+        }
+        _dash_cache_put("dash", data)
+
+    return templates.TemplateResponse(
+        "admin/dashboard.html",
+        {
+            "request": request,
+            "active_page": "dashboard",
+            **data,
+        },
+    )
 
 
 # -------------------------------------------------------------
 # ИНВОЙСЫ
 # -------------------------------------------------------------
 @app.get("/admin/invoices", name="invoices_list")
-def invoices_list(request: Request):
+async def invoices_list(
+    request: Request,
+    before_id: int | None = None,
+    db: AsyncSession = Depends(get_db),
+):
     """
     Список инвойсов — для контроля очереди.
+
+    Пагинация keyset-ом (?before_id=N → строки с id < N): в отличие от
+    OFFSET не деградирует на глубоких страницах, а сортировка по id desc
+    идёт прямо по первичному ключу.
     """
-    db = SessionLocal()
-    try:
-        invoices = (
-            db.query(Invoice)
-            .order_by(Invoice.id.desc())
-            .limit(100)
-            .all()
-        )
-        return templates.TemplateResponse(
-            "admin/invoices_list.html",
-            {
-                "request": request,
-                "active_page": "invoices",
-                "invoices": invoices,
-            },
-        )
-    finally:
-        db.close()
+    # Грузим только колонки, которые реально показывает шаблон, и
+    # raiseload("*") — чтобы случайный lazy-load (N+1) падал громко,
+    # а не молча делал запрос на каждую строку.
+    stmt = select(Invoice).options(
+        load_only(
+            Invoice.id,
+            Invoice.invoice_id,
+            Invoice.amount,
+            Invoice.currency,
+            Invoice.status,
+            Invoice.recipient_name,
+            Invoice.recipient_card_number,
+            Invoice.deeplink,
+            Invoice.error_message,
+            Invoice.created_at,
+            Invoice.updated_at,
+        ),
+        raiseload("*"),
+    )
+    if before_id is not None:
+        stmt = stmt.where(Invoice.id < before_id)
+    stmt = stmt.order_by(Invoice.id.desc()).limit(INVOICES_PAGE_SIZE)
+    invoices = (await db.execute(stmt)).scalars().all()
+
+    # курсор на следующую (более старую) страницу
+    next_before_id = (
+        invoices[-1].id if len(invoices) == INVOICES_PAGE_SIZE else None
+    )
+
+    return templates.TemplateResponse(
+        "admin/invoices_list.html",
+        {
+            "request": request,
+            "active_page": "invoices",
+            "invoices": invoices,
+            "next_before_id": next_before_id,
+        },
+    )
 
 
 @app.get("/admin/invoices/create", name="invoices_create_form")
@@ -163,135 +393,120 @@ def invoices_create_form(request: Request):
     )
 
 
-@app.post("/admin/invoices/create", name="invoices_create")
-def invoices_create(
-    request: Request,
+class CreateInvoiceForm(BaseModel):
+    """
+    Форма создания инвойса.
+
+    str_strip_whitespace=True — pydantic-core сам триммит все строковые
+    поля при валидации, вместо двух десятков ручных .strip() в хендлере.
+    """
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     # --- базовые поля инвойса ---
-    invoice_id: str = Form(...),
-    amount: float = Form(...),
-    currency: str = Form("RUB"),
-    callback_url: str | None = Form(None),
+    invoice_id: str
+    amount: float
+    currency: str = "RUB"
+    callback_url: str | None = None
 
     # --- ПОЛУЧАТЕЛЬ ---
-    recipient_country: str = Form(...),
-    recipient_bank: str = Form(...),
-    recipient_card_number: str = Form(...),
-    recipient_first_name: str = Form(...),
-    recipient_last_name: str = Form(...),
-    recipient_requisites: str | None = Form(None),
+    recipient_country: str
+    recipient_bank: str
+    recipient_card_number: str
+    recipient_first_name: str
+    recipient_last_name: str
+    recipient_requisites: str | None = None
 
     # --- ОТПРАВИТЕЛЬ ---
-    sender_first_name: str = Form(...),
-    sender_last_name: str = Form(...),
-    sender_middle_name: str | None = Form(None),
+    sender_first_name: str
+    sender_last_name: str
+    sender_middle_name: str | None = None
+
+    sender_passport_type: str = "rf_national"
+    sender_passport_series: str
+    sender_passport_number: str
+    sender_passport_country: str = "Россия"
+    sender_passport_issue_date: str
+
+    sender_birth_date: str
+    sender_birth_country: str = "Россия"
+    sender_birth_place: str
+
+    sender_registration_country: str = "Россия"
+    sender_registration_place: str
 
-    sender_passport_type: str = Form("rf_national"),
-    sender_passport_series: str = Form(...),
-    sender_passport_number: str = Form(...),
-    sender_passport_country: str = Form("Россия"),
-    sender_passport_issue_date: str = Form(...),
+    sender_phone: str
 
-    sender_birth_date: str = Form(...),
-    sender_birth_country: str = Form("Россия"),
-    sender_birth_place: str = Form(...),
+    @field_validator("callback_url", "sender_middle_name", "recipient_requisites")
+    @classmethod
+    def _empty_to_none(cls, v: str | None) -> str | None:
+        # пустая строка из формы эквивалентна «не заполнено»
+        return v or None
 
-    sender_registration_country: str = Form("Россия"),
-    sender_registration_place: str = Form(...),
 
-    sender_phone: str = Form(...),
+@app.post("/admin/invoices/create", name="invoices_create")
+async def invoices_create(
+    request: Request,
+    form: Annotated[CreateInvoiceForm, Form()],
+    db: AsyncSession = Depends(get_db),
 ):
     """
     Создание нового инвойса в статусе queued.
     Все поля маппим на детализированную модель Invoice.
     """
-    db = SessionLocal()
-    try:
-        # ФИО получателя для легаси-полей
-        recipient_full_name = f"{recipient_first_name} {recipient_last_name}".strip()
-
-        # ФИО отправителя (легаси sender_name)
-        sender_full_name_parts = [sender_last_name, sender_first_name]
-        if sender_middle_name:
-            sender_full_name_parts.append(sender_middle_name)
-        sender_full_name = " ".join(p for p in sender_full_name_parts if p)
-
-        # Легаси-реквизиты — номер карты + банк + доп. текст, если есть
-        base_requisites = f"Карта: {recipient_card_number}, Банк: {recipient_bank}"
-        if recipient_requisites:
-            recipient_requisites_full = base_requisites + f", {recipient_requisites.strip()}"
-        else:
-            recipient_requisites_full = base_requisites
-
-        inv = Invoice(
-            invoice_id=invoice_id.strip(),
-            amount=float(amount),
-            currency=currency.strip(),
-
-            # получатель — новые поля
-            recipient_country=recipient_country.strip(),
-            recipient_bank=recipient_bank.strip(),
-            recipient_card_number=recipient_card_number.strip(),
-            recipient_first_name=recipient_first_name.strip(),
-            recipient_last_name=recipient_last_name.strip(),
-
-            # получатель — legacy-поля
-            recipient_name=recipient_full_name,
-            recipient_requisites=recipient_requisites_full,
-
-            # отправитель — новые поля
-            sender_first_name=sender_first_name.strip(),
-            sender_last_name=sender_last_name.strip(),
-            sender_middle_name=sender_middle_name.strip() if sender_middle_name else None,
-            sender_passport_type=sender_passport_type.strip(),
-            sender_passport_series=sender_passport_series.strip(),
-            sender_passport_number=sender_passport_number.strip(),
-            sender_passport_country=sender_passport_country.strip(),
-            sender_passport_issue_date=sender_passport_issue_date.strip(),
-            sender_birth_date=sender_birth_date.strip(),
-            sender_birth_country=sender_birth_country.strip(),
-            sender_birth_place=sender_birth_place.strip(),
-            sender_registration_country=sender_registration_country.strip(),
-            sender_registration_place=sender_registration_place.strip(),
-            sender_phone=sender_phone.strip(),
-
-            # отправитель — legacy-поле
-            sender_name=sender_full_name,
-
-            callback_url=callback_url.strip() if callback_url else None,
-            status="queued",
-        )
+    # ФИО получателя для легаси-полей
+    recipient_full_name = f"{form.recipient_first_name} {form.recipient_last_name}".strip()
+
+    # ФИО отправителя (легаси sender_name)
+    sender_full_name_parts = [form.sender_last_name, form.sender_first_name]
+    if form.sender_middle_name:
+        sender_full_name_parts.append(form.sender_middle_name)
+    sender_full_name = " ".join(p for p in sender_full_name_parts if p)
+
+    # Легаси-реквизиты — номер карты + банк + доп. текст, если есть
+    base_requisites = f"Карта: {form.recipient_card_number}, Банк: {form.recipient_bank}"
+    if form.recipient_requisites:
+        recipient_requisites_full = base_requisites + f", {form.recipient_requisites}"
+    else:
+        recipient_requisites_full = base_requisites
+
+    inv = Invoice(
+        **form.model_dump(exclude={"recipient_requisites"}),
 
-        db.add(inv)
-        db.commit()
+        # получатель/отправитель — legacy-поля
+        recipient_name=recipient_full_name,
+        recipient_requisites=recipient_requisites_full,
+        sender_name=sender_full_name,
+
+        status="queued",
+    )
 
-        return RedirectResponse("/admin/invoices", status_code=HTTP_302_FOUND)
+    db.add(inv)
+    await db.commit()
+    _dash_cache_invalidate()
 
-    finally:
-        db.close()
+    return RedirectResponse("/admin/invoices", status_code=HTTP_302_FOUND)
 
 
 # -------------------------------------------------------------
 # ПРОКСИ
 # -------------------------------------------------------------
 @app.get("/admin/proxies")
-def list_proxies(request: Request):
-    db = SessionLocal()
-    try:
-        proxies = db.query(Proxy).order_by(Proxy.id.asc()).all()
-        return templates.TemplateResponse(
-            "admin/proxies.html",
-            {
-                "request": request,
-                "active_page": "proxies",
-                "proxies": proxies,
-            },
-        )
-    finally:
-        db.close()
+async def list_proxies(request: Request, db: AsyncSession = Depends(get_db)):
+    proxies = (
+        await db.execute(select(Proxy).order_by(Proxy.id.asc()))
+    ).scalars().all()
+    return templates.TemplateResponse(
+        "admin/proxies.html",
+        {
+            "request": request,
+            "active_page": "proxies",
+            "proxies": proxies,
+        },
+    )
 
 
 @app.post("/admin/proxies/add")
-def add_proxy(
+async def add_proxy(
     host: str = Form(...),
     port_http: int | None = Form(None),
     port_socks5: int | None = Form(None),
@@ -300,83 +515,73 @@ def add_proxy(
     protocol: str = Form("http"),
     label: str | None = Form(None),
     is_active: str | None = Form(None),  # чекбокс приходит как "on"
+    db: AsyncSession = Depends(get_db),
 ):
-    db = SessionLocal()
-    try:
-        proxy = Proxy(
-            host=host.strip(),
-            port_http=port_http,
-            port_socks5=port_socks5,
-            username=username or None,
-            password=password or None,
-            protocol=protocol,
-            label=label or host,
-            is_active=True if is_active else False,
-        )
-        db.add(proxy)
-        db.commit()
+    proxy = Proxy(
+        host=host.strip(),
+        port_http=port_http,
+        port_socks5=port_socks5,
+        username=username or None,
+        password=password or None,
+        protocol=protocol,
+        label=label or host,
+        is_active=True if is_active else False,
+    )
+    db.add(proxy)
+    await db.commit()
+    _dash_cache_invalidate()
 
-        return RedirectResponse("/admin/proxies", status_code=HTTP_302_FOUND)
-    finally:
-        db.close()
+    return RedirectResponse("/admin/proxies", status_code=HTTP_302_FOUND)
 
 
 @app.post("/admin/proxies/{proxy_id}/toggle")
-def toggle_proxy(proxy_id: int):
-    db = SessionLocal()
-    try:
-        proxy = db.query(Proxy).filter(Proxy.id == proxy_id).first()
-        if not proxy:
-            raise HTTPException(404, "Proxy not found")
+async def toggle_proxy(proxy_id: int, db: AsyncSession = Depends(get_db)):
+    proxy = await db.get(Proxy, proxy_id)
+    if not proxy:
+        raise HTTPException(404, "Proxy not found")
 
-        proxy.is_active = not proxy.is_active
-        db.commit()
+    proxy.is_active = not proxy.is_active
+    await db.commit()
+    _dash_cache_invalidate()
 
-        return RedirectResponse("/admin/proxies", status_code=HTTP_302_FOUND)
-    finally:
-        db.close()
+    return RedirectResponse("/admin/proxies", status_code=HTTP_302_FOUND)
 
 
 @app.post("/admin/proxies/{proxy_id}/delete")
-def delete_proxy(proxy_id: int):
-    db = SessionLocal()
-    try:
-        proxy = db.query(Proxy).filter(Proxy.id == proxy_id).first()
-        if proxy:
-            db.delete(proxy)
-            db.commit()
+async def delete_proxy(proxy_id: int, db: AsyncSession = Depends(get_db)):
+    proxy = await db.get(Proxy, proxy_id)
+    if proxy:
+        await db.delete(proxy)
+        await db.commit()
+        _dash_cache_invalidate()
 
-        return RedirectResponse("/admin/proxies", status_code=HTTP_302_FOUND)
-    finally:
-        db.close()
+    return RedirectResponse("/admin/proxies", status_code=HTTP_302_FOUND)
 
 
 # -------------------------------------------------------------
 # НАСТРОЙКИ (API-ключи капч)
 # -------------------------------------------------------------
 @app.get("/admin/settings")
-def settings_page(request: Request):
-    db = SessionLocal()
-    try:
-        values = {k: _db_get_setting(db, k) for k in CAPTCHA_KEYS}
-
-        return templates.TemplateResponse(
-            "admin/settings.html",
-            {
-                "request": request,
-                "active_page": "settings",
-                "settings": values,
-            },
-        )
-    finally:
-        db.close()
+async def settings_page(request: Request, db: AsyncSession = Depends(get_db)):
+    stored = await _db_get_settings(db, CAPTCHA_KEYS)
+    values = {k: stored.get(k, "") for k in CAPTCHA_KEYS}
+
+    return templates.TemplateResponse(
+        "admin/settings.html",
+        {
+            "request": request,
+            "active_page": "settings",
+            "settings": values,
+        },
+    )
 
 
 @app.post("/admin/settings")
-def save_settings(
+async def save_settings(
     rucaptcha_key: str = Form(""),
     twocaptcha_key: str = Form(""),
     capsolver_key: str = Form(""),
+    db: AsyncSession = Depends(get_db),
 ):
     mapping = {
         "RUCAPTCHA_KEY": rucaptcha_key.strip(),
@@ -384,58 +589,42 @@ def save_settings(
         "CAPSOLVER_KEY": capsolver_key.strip(),
     }
 
-    db = SessionLocal()
-    try:
-        for key, value in mapping.items():
-            row = db.query(Setting).filter(Setting.key == key).first()
-
-            if not row:
-                row = Setting(key=key, value=value)
-                db.add(row)
-            else:
-                row.value = value
-
-        db.commit()
+    await _db_set_settings(db, mapping)
+    _dash_cache_invalidate()
 
-        return RedirectResponse("/admin/settings", status_code=HTTP_302_FOUND)
-    finally:
-        db.close()
+    return RedirectResponse("/admin/settings", status_code=HTTP_302_FOUND)
 
 
 # -------------------------------------------------------------
 # УПРАВЛЕНИЕ ВОРКЕРАМИ (AGENT / PRMONEY)
 # -------------------------------------------------------------
 @app.post("/admin/workers/toggle_agent", name="toggle_agent_worker")
-def toggle_agent_worker():
+async def toggle_agent_worker(db: AsyncSession = Depends(get_db)):
     """
     Включение/выключение основного агента.
     workers.py должен сам смотреть на флаг AGENT_WORKER_ENABLED.
     """
-    db = SessionLocal()
-    try:
-        cur = _db_get_setting(db, WORKER_AGENT_KEY)
-        new_val = "0" if cur == "1" else "1"
-        _db_set_setting(db, WORKER_AGENT_KEY, new_val)
-        return RedirectResponse("/admin", status_code=HTTP_302_FOUND)
-    finally:
-        db.close()
+    cur = await _db_get_setting(db, WORKER_AGENT_KEY)
+    new_val = "0" if cur == "1" else "1"
+    await _db_set_setting(db, WORKER_AGENT_KEY, new_val)
+    _dash_cache_invalidate()
+    return RedirectResponse("/admin", status_code=HTTP_302_FOUND)
 
 
 @app.post("/admin/workers/toggle_prmoney", name="toggle_prmoney_worker")
-def toggle_prmoney_worker():
+async def toggle_prmoney_worker(db: AsyncSession = Depends(get_db)):
     """
     Включение/выключение PrMoney-воркера.
     workers.py должен сам смотреть на флаг PRMONEY_WORKER_ENABLED.
     """
-    db = SessionLocal()
-    try:
-        cur = _db_get_setting(db, WORKER_PRMONEY_KEY)
-        new_val = "0" if cur == "1" else "1"
-        _db_set_setting(db, WORKER_PRMONEY_KEY, new_val)
-        _db_set_setting(db, "SESSION_MESSAGE", "")  # опционально: чистим сообщение
-        return RedirectResponse("/admin", status_code=HTTP_302_FOUND)
-    finally:
-        db.close()
+    cur = await _db_get_setting(db, WORKER_PRMONEY_KEY)
+    new_val = "0" if cur == "1" else "1"
+    await _db_set_settings(db, {
+        WORKER_PRMONEY_KEY: new_val,
+        "SESSION_MESSAGE": "",  # опционально: чистим сообщение
+    })
+    _dash_cache_invalidate()
+    return RedirectResponse("/admin", status_code=HTTP_302_FOUND)
 
 
 # -------------------------------------------------------------
@@ -466,45 +655,59 @@ class InvoiceDeeplinkPayload(BaseModel):
 
 
 @app.post("/callbacks/invoice/deeplink", name="invoice_deeplink_callback")
-def invoice_deeplink_callback(payload: InvoiceDeeplinkPayload):
+async def invoice_deeplink_callback(
+    payload: InvoiceDeeplinkPayload, db: AsyncSession = Depends(get_db)
+):
     """
     Принимаем постбек с диплинком:
       - пытаемся найти инвойс по внутреннему ID (invoice_id),
       - если не нашли, ищем по внешнему invoice_external_id,
       - обновляем deeplink и статус.
     """
-    db = SessionLocal()
-    try:
-        # 1) ищем по внутреннему ID (Invoice.id)
-        invoice = db.query(Invoice).filter(Invoice.id == payload.invoice_id).first()
-
-        # 2) если не нашли — пробуем по внешнему invoice_id (строка)
-        if not invoice:
-            invoice = (
-                db.query(Invoice)
-                .filter(Invoice.invoice_id == str(payload.invoice_external_id))
-                .first()
-            )
+    # Статус внешней платёжной системы — произвольная строка; всё, что
+    # не входит в наш закрытый список, сводим к "created" (колбэк и
+    # значит «диплинк создан»), иначе Enum упадёт на биндинге
+    status = (
+        payload.status if payload.status in INVOICE_STATUSES else "created"
+    )
 
-        if not invoice:
-            print(
-                f"[CALLBACK] Не найден инвойс ни по id={payload.invoice_id}, "
-                f"ни по invoice_id={payload.invoice_external_id}"
+    # Ищем по внутреннему id, при промахе — по внешнему invoice_id.
+    # Каждый предикат — отдельный UPDATE ... RETURNING (вместо
+    # SELECT + UPDATE + REFRESH): OR-форма обновила бы СРАЗУ ДВА
+    # инвойса, если предикаты совпадут с разными строками.
+    def _claim(where):
+        return (
+            update(Invoice)
+            .where(where)
+            .values(
+                deeplink=payload.deeplink,
+                status=status,
             )
-            raise HTTPException(status_code=404, detail="Invoice not found")
-
-        # Обновляем диплинк и статус
-        invoice.deeplink = payload.deeplink
-        invoice.status = payload.status or "created"
+            .returning(Invoice.id, Invoice.status, Invoice.deeplink)
+            .execution_options(synchronize_session=False)
+        )
 
-        db.commit()
-        db.refresh(invoice)
+    row = (await db.execute(_claim(Invoice.id == payload.invoice_id))).first()
+    if not row:
+        row = (
+            await db.execute(
+                _claim(Invoice.invoice_id == str(payload.invoice_external_id))
+            )
+        ).first()
 
+    if not row:
         print(
-            f"[CALLBACK] Обновлён инвойс id={invoice.id}: "
-            f"status={invoice.status}, deeplink={invoice.deeplink}"
+            f"[CALLBACK] Не найден инвойс ни по id={payload.invoice_id}, "
+            f"ни по invoice_id={payload.invoice_external_id}"
         )
+        raise HTTPException(status_code=404, detail="Invoice not found")
+
+    await db.commit()
+    _dash_cache_invalidate()
+
+    print(
+        f"[CALLBACK] Обновлён инвойс id={row.id}: "
+        f"status={row.status}, deeplink={row.deeplink}"
+    )
 
-        return {"ok": True}
-    finally:
-        db.close()
\ No newline at end of file
+    return {"ok": True}
\ No newline at end of file
@@ -1,25 +1,31 @@
 from __future__ import annotations
 
 import asyncio
+import logging
+import queue
+import time
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from typing import Optional
 
-import requests
+import httpx
 from dotenv import load_dotenv
+from sqlalchemy import select, update
 from playwright.async_api import (
     async_playwright,
     Page,
     BrowserContext,
 )
 
-from db import SessionLocal
+from db import SessionLocal, engine, insert_for_dialect
 from models import Invoice, Setting
 from agent_config import (
     MULTITRANSFER_BASE_URL,
     NAVIGATION_TIMEOUT_MS,
     DEFAULT_USER_AGENT,
     MAX_CONCURRENT_INVOICES,
+    AGENT_HEADLESS,
 )
 
 # шаги
@@ -33,105 +39,248 @@ from proxy_manager import get_next_proxy_for_launch, mark_proxy_fail, mark_proxy
 
 load_dotenv()
 
+# --------------------------------------------
+# ЛОГИРОВАНИЕ
+# --------------------------------------------
+# Логи уходят через очередь в фоновый тред: форматирование и запись
+# в stdout не держат GIL/event loop в горячем пути (print блокируется
+# на line-buffered stdout на каждый вызов). Болтливые [RUNNER]/[TAB]
+# сообщения — на уровне DEBUG, в проде они отфильтровываются сразу.
+log = logging.getLogger("aideon.agent")
+if not log.handlers:
+    log.setLevel(logging.INFO)
+    _log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    log.addHandler(QueueHandler(_log_queue))
+    _log_listener = QueueListener(_log_queue, logging.StreamHandler())
+    _log_listener.start()
+
 WEBHOOK_URL = "https://joker-pay.com/webhook/tips"
 
+# Общий HTTP-клиент для вебхуков: keep-alive амортизирует TCP+TLS
+# хендшейк между всеми отправками и не блокирует event loop Playwright.
+_http = httpx.AsyncClient(
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=10),
+)
+
+# Фоновые задачи (вебхуки об ошибках, флаш waiting_captcha, ресайкл
+# контекстов). asyncio держит Task'и только по слабой ссылке — без
+# своего set'а сборщик может убить задачу до завершения. На shutdown
+# run_agent дожидается хвоста, прежде чем закрыть _http.
+_bg_tasks: set[asyncio.Task] = set()
+
+
+def _spawn_bg(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    return task
+
 # --------------------------------------------
 # DEBUG: не закрывать вкладки после обработки
 # --------------------------------------------
 DEBUG_KEEP_TABS = True  # True → вкладки остаются открытыми для отладки
 
-# Путь к Aideon Helper JS (новый модуль)
+# Путь к Aideon Helper JS (новый модуль).
+# Читаем один раз при импорте — файл не меняется на лету, а перечитывать
+# и декодировать его на каждую вкладку незачем.
 HELPER_JS_PATH = Path(__file__).resolve().parent / "browser" / "aideon_helper.js"
+HELPER_JS_CODE: Optional[str] = (
+    HELPER_JS_PATH.read_text(encoding="utf-8") if HELPER_JS_PATH.exists() else None
+)
+
+# Баннер «пройди капчу»: регистрируется один раз на контекст как init-script,
+# чтобы не гонять ~1КБ исходника через CDP на каждый инвойс — при показе
+# через evaluate уходит только короткий вызов window.__aideonShowBanner(id).
+BANNER_JS_FUNCTION_SRC = """
+window.__aideonShowBanner = (id) => {
+    const elId = 'aideon-captcha-banner';
+    let el = document.getElementById(elId);
+    if (!el) {
+        el = document.createElement('div');
+        el.id = elId;
+        // один cssText вместо 11 отдельных сеттеров стилей —
+        // одна инвалидация layout вместо одиннадцати
+        el.style.cssText =
+            'position:fixed;top:0;left:0;right:0;z-index:999999;' +
+            'background:#ff3333;color:#fff;padding:10px 16px;' +
+            'font-size:16px;font-family:sans-serif;text-align:center';
+        document.body.appendChild(el);
+    }
+    el.textContent = 'Aideon Agent: пройди капчу для инвойса ' + id;
+};
+"""
 
 
 # ============================================================
 # SETTINGS / STATUS
 # ============================================================
 
-def _set_setting(key: str, value: str) -> None:
+def _set_settings(mapping: dict[str, str]) -> None:
+    """
+    Пишет несколько настроек одним INSERT ... ON CONFLICT(key) DO UPDATE
+    (вместо SELECT + INSERT/UPDATE и гидрации ORM-объектов на каждый ключ).
+    """
+    if not mapping:
+        return
+    insert_fn = insert_for_dialect()
+    stmt = insert_fn(Setting)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["key"],
+        set_={"value": stmt.excluded.value},
+    )
     db = SessionLocal()
     try:
-        row = db.query(Setting).filter(Setting.key == key).first()
-        if not row:
-            row = Setting(key=key, value=value)
-            db.add(row)
-        else:
-            row.value = value
+        db.execute(stmt, [{"key": k, "value": v} for k, v in mapping.items()])
         db.commit()
     finally:
         db.close()
 
 
+def _set_setting(key: str, value: str) -> None:
+    _set_settings({key: value})
+
+
+# Статус сессии пишется из каждого цикла и каждого инвойса — в БД его
+# сбрасывает фоновый флашер не чаще раза в ~0.5с, иначе это тысячи
+# мелких commit/fsync в горячем пути.
+_session_state: dict[str, str] = {}
+_session_dirty = asyncio.Event()
+_STATUS_FLUSH_DELAY_SECONDS = 0.5
+
+
+# Кэш ISO-времени с точностью до секунды: статус и вебхуки зовут его
+# на каждый тик/инвойс, а новый strftime нужен не чаще раза в секунду.
+_NOW_ISO_CACHE: list = [0, ""]
+
+
+def _now_iso() -> str:
+    t = int(time.time())
+    if t != _NOW_ISO_CACHE[0]:
+        _NOW_ISO_CACHE[0] = t
+        _NOW_ISO_CACHE[1] = datetime.utcfromtimestamp(t).isoformat(timespec="seconds")
+    return _NOW_ISO_CACHE[1]
+
+
 def _mark_session_status(status: str, message: str = "") -> None:
-    now = datetime.utcnow().isoformat(timespec="seconds")
-    _set_setting("SESSION_STATUS", status)
-    _set_setting("SESSION_MESSAGE", message or "")
-    _set_setting("SESSION_UPDATED_AT", now)
+    _session_state.update({
+        "SESSION_STATUS": status,
+        "SESSION_MESSAGE": message or "",
+        "SESSION_UPDATED_AT": _now_iso(),
+    })
+    _session_dirty.set()
+
+
+async def _status_flusher() -> None:
+    """Фоновая задача: коалесцирует статусы и пишет их одним апсертом."""
+    while True:
+        await _session_dirty.wait()
+        # даём статусам накопиться — пишем самое свежее состояние
+        await asyncio.sleep(_STATUS_FLUSH_DELAY_SECONDS)
+        _session_dirty.clear()
+        snapshot = dict(_session_state)
+        try:
+            await asyncio.to_thread(_set_settings, snapshot)
+        except Exception as e:
+            log.error(f"[STATUS] Ошибка записи статуса сессии: {e}")
 
 
 # ============================================================
 #   ФИНАЛИЗАЦИЯ ОШИБКИ ДО STEP4
 # ============================================================
 
-def _finalize_invoice_error_any_step(invoice_id: int, error_message: str) -> None:
-    db = SessionLocal()
-    inv: Optional[Invoice] = None
+def _finalize_invoice_error_db(db, invoice_id: int, error_message: str) -> dict:
+    """
+    Флипает инвойс в error на УЖЕ открытой сессии process_invoice
+    (без нового checkout из пула и PRAGMA-setup на соединении)
+    и возвращает payload для вебхука.
+    """
+    # Поля для вебхука снимаем, пока строка привязана к сессии —
+    # после commit атрибуты детачатся.
+    inv_external_id: Optional[str] = None
+    inv_amount: float = 0.0
+    inv_currency: str = "643"
+
     try:
+        # чистим упавшую транзакцию, в которой свалился process_invoice
+        db.rollback()
         inv = db.query(Invoice).filter(Invoice.id == invoice_id).first()
         if inv:
+            inv_external_id = inv.invoice_id
+            inv_amount = float(inv.amount or 0)
+            inv_currency = inv.currency or "643"
             inv.status = "error"
             inv.error_message = error_message
             inv.deeplink = None
             db.commit()
-            print(
-                f"[AGENT-ERROR] Инвойс id={inv.id} обновлён: "
-                f"status=error, error_message={inv.error_message}"
+            log.info(
+                f"[AGENT-ERROR] Инвойс id={invoice_id} обновлён: "
+                f"status=error, error_message={error_message}"
             )
         else:
-            print(f"[AGENT-ERROR] Не найден invoice id={invoice_id} для финализации.")
+            log.error(f"[AGENT-ERROR] Не найден invoice id={invoice_id} для финализации.")
     except Exception as e:
         db.rollback()
-        print(f"[AGENT-ERROR] Ошибка записи ошибки в БД для invoice={invoice_id}: {e}")
-    finally:
-        try:
-            db.close()
-        except Exception:
-            pass
+        log.error(f"[AGENT-ERROR] Ошибка записи ошибки в БД для invoice={invoice_id}: {e}")
 
-    payload = {
+    return {
         "invoice_id": invoice_id,
-        "invoice_external_id": getattr(inv, "invoice_id", None) if inv else None,
-        "amount": float(getattr(inv, "amount", 0) or 0) if inv else 0,
-        "currency": getattr(inv, "currency", "643") if inv else "643",
+        "invoice_external_id": inv_external_id,
+        "amount": inv_amount,
+        "currency": inv_currency,
         "deeplink": "",
         "status": "No Terminals",
-        "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "created_at": _now_iso(),
         "error": error_message,
     }
 
-    print(f"[AGENT-ERROR] POST (No Terminals) → {WEBHOOK_URL}")
-    print(f"[AGENT-ERROR] Payload: {payload}")
+
+def _flush_waiting_captcha(invoice_id: int) -> None:
+    """Пишет статус waiting_captcha одним core-UPDATE (вызывается из тредпула)."""
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(Invoice)
+            .where(Invoice.id == invoice_id)
+            .values(status="waiting_captcha", error_message=None)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        log.error(f"[FLOW] Ошибка записи waiting_captcha для invoice={invoice_id}: {e}")
+    finally:
+        db.close()
+
+
+async def _post_error_webhook(payload: dict) -> None:
+    log.error(f"[AGENT-ERROR] POST (No Terminals) → {WEBHOOK_URL}")
+    log.error(f"[AGENT-ERROR] Payload: {payload}")
 
     try:
-        r = requests.post(WEBHOOK_URL, json=payload, timeout=10)
-        print(f"[AGENT-ERROR] Ответ: {r.status_code} {r.text[:200]}")
+        r = await _http.post(WEBHOOK_URL, json=payload)
+        log.error(f"[AGENT-ERROR] Ответ: {r.status_code} {r.text[:200]}")
     except Exception as e:
-        print(f"[AGENT-ERROR] Webhook error: {e}")
+        log.error(f"[AGENT-ERROR] Webhook error: {e}")
 
 
 # ============================================================
 #   PLAYWRIGHT CONTEXT + ПРОКСИ (АКТУАЛЬНАЯ ВЕРСИЯ)
 # ============================================================
 
-async def open_context(play) -> BrowserContext:
+async def open_browser(play):
     """
-    Открываем Chromium-контекст.
-    Используем прокси из БД (ProxyLaunchConfig), если он есть и активен.
+    Запускаем Chromium (один на всех — запуск браузера самая дорогая
+    операция пайплайна). Используем прокси из БД (ProxyLaunchConfig),
+    если он есть и активен.
     """
-    proxy_cfg = get_next_proxy_for_launch()
+    # прокси-менеджер ходит в БД синхронно — уводим его в тредпул,
+    # чтобы не стопорить event loop Playwright на время DB I/O
+    proxy_cfg = await asyncio.to_thread(get_next_proxy_for_launch)
 
     launch_kwargs: dict = {
-        "headless": False,
+        # headful, пока капчу проходит человек; см. AGENT_HEADLESS
+        "headless": AGENT_HEADLESS,
         "args": [
             f"--user-agent={DEFAULT_USER_AGENT}",
             "--disable-blink-features=AutomationControlled",
@@ -140,7 +289,7 @@ async def open_context(play) -> BrowserContext:
 
     if proxy_cfg:
         # proxy_cfg: ProxyLaunchConfig(id, label, protocol, server, username, password)
-        print(
+        log.info(
             "[PROXY] Используем прокси для браузера: "
             f"id={proxy_cfg.id}, label={proxy_cfg.label!r}, "
             f"protocol={proxy_cfg.protocol!r}, server={proxy_cfg.server!r}"
@@ -153,7 +302,7 @@ async def open_context(play) -> BrowserContext:
             "password": proxy_cfg.password or None,
         }
     else:
-        print("[PROXY] Активных прокси в БД нет → запускаем без прокси")
+        log.info("[PROXY] Активных прокси в БД нет → запускаем без прокси")
 
     try:
         browser = await play.chromium.launch(**launch_kwargs)
@@ -161,50 +310,157 @@ async def open_context(play) -> BrowserContext:
         # если есть прокси — помечаем его как упавший
         if proxy_cfg:
             try:
-                mark_proxy_fail(proxy_cfg.id)
+                await asyncio.to_thread(mark_proxy_fail, proxy_cfg.id)
             except Exception as ie:
-                print(f"[PROXY] Ошибка при mark_proxy_fail: {ie}")
+                log.error(f"[PROXY] Ошибка при mark_proxy_fail: {ie}")
         raise
 
     # Если браузер успешно поднялся — считаем, что прокси живой
     if proxy_cfg:
         try:
-            mark_proxy_success(proxy_cfg.id)
+            await asyncio.to_thread(mark_proxy_success, proxy_cfg.id)
         except Exception as ie:
-            print(f"[PROXY] Ошибка при mark_proxy_success: {ie}")
+            log.error(f"[PROXY] Ошибка при mark_proxy_success: {ie}")
+
+    return browser
 
+
+async def new_agent_context(browser) -> BrowserContext:
+    """
+    Новый контекст с нашими настройками и init-скриптами.
+    Helper JS и баннер капчи регистрируются один раз на контекст —
+    V8 парсит их по разу, а не на каждую страницу.
+    """
     context = await browser.new_context(
         viewport={"width": 1366, "height": 768},
         user_agent=DEFAULT_USER_AGENT,
     )
     context.set_default_navigation_timeout(NAVIGATION_TIMEOUT_MS)
     context.set_default_timeout(NAVIGATION_TIMEOUT_MS)
+
+    try:
+        await context.add_init_script(BANNER_JS_FUNCTION_SRC)
+    except Exception as e:
+        log.error(f"[CAPTCHA] Ошибка регистрации init-script баннера: {e}")
+
+    if HELPER_JS_CODE:
+        try:
+            await context.add_init_script(HELPER_JS_CODE)
+        except Exception as e:
+            log.error(f"[AIDEON-HELPER] Ошибка инжекта helper JS в контекст: {e}")
+    else:
+        log.info(f"[AIDEON-HELPER] WARN: файл {HELPER_JS_PATH} не найден, helper не подключён")
+
     return context
 
 
+# Сколько инвойсов контекст отрабатывает до пересоздания. Долгоживущие
+# контексты в Playwright копят память (route-хуки, листенеры, кэш DOM),
+# а новый контекст почти бесплатен по сравнению с запуском браузера —
+# поэтому периодически закрываем контекст и создаём свежий.
+RECYCLE_CONTEXT_AFTER_INVOICES = 50
+
+
+class ContextPool:
+    """
+    Пул переиспользуемых BrowserContext (размером с лимит параллельных
+    инвойсов). Контексты создаются лениво и живут между инвойсами, так
+    что на каждый следующий инвойс остаётся только дешёвый new_page().
+    После RECYCLE_CONTEXT_AFTER_INVOICES инвойсов контекст закрывается
+    и на его место лениво создаётся новый — это сбрасывает утечку памяти.
+    """
+
+    def __init__(self, browser, size: int):
+        self._browser = browser
+        self._size = size
+        self._created = 0
+        self._uses: dict[int, int] = {}
+        self._queue: asyncio.Queue[BrowserContext] = asyncio.Queue(size)
+
+    async def acquire(self) -> BrowserContext:
+        if self._queue.empty() and self._created < self._size:
+            self._created += 1
+            return await new_agent_context(self._browser)
+        return await self._queue.get()
+
+    def release(self, context: BrowserContext) -> None:
+        uses = self._uses.get(id(context), 0) + 1
+        if uses >= RECYCLE_CONTEXT_AFTER_INVOICES:
+            # контекст отработал своё — закрываем в фоне, слот вернётся
+            # через ленивое создание в acquire()
+            self._uses.pop(id(context), None)
+            self._created -= 1
+            _spawn_bg(self._close_quietly(context))
+        else:
+            self._uses[id(context)] = uses
+            self._queue.put_nowait(context)
+
+    def discard(self, context: BrowserContext) -> None:
+        """
+        Выбросить мёртвый контекст (например, после краша браузера или
+        прокси), НЕ возвращая его в очередь: слот восстановится через
+        ленивое создание в acquire(), сам контекст тихо закрываем.
+        """
+        self._uses.pop(id(context), None)
+        self._created -= 1
+        _spawn_bg(self._close_quietly(context))
+
+    @staticmethod
+    async def _close_quietly(context: BrowserContext) -> None:
+        try:
+            await context.close()
+        except Exception as e:
+            log.error(f"[POOL] Ошибка закрытия контекста при ресайкле: {e}")
+
+
 # ============================================================
 #   ПОЛУЧИТЬ СЛЕДУЮЩИЙ INVOICE
 # ============================================================
 
-def get_next_invoice() -> Optional[Invoice]:
+def get_next_invoices(limit: int) -> list[Invoice]:
+    """
+    Атомарно забирает из очереди до `limit` инвойсов одним
+    UPDATE ... RETURNING (вместо SELECT+UPDATE+COMMIT+REFRESH на каждый).
+    FOR UPDATE SKIP LOCKED во внутреннем select не даёт двум воркерам
+    взять одни и те же строки (на Postgres; SQLite диалект FOR UPDATE
+    не рендерит — там писатель и так один, а сам UPDATE атомарен).
+    """
+    if limit <= 0:
+        return []
+
     db = SessionLocal()
     try:
-        inv = (
-            db.query(Invoice)
-            .filter(Invoice.status == "queued")
+        claim_ids = (
+            select(Invoice.id)
+            .where(Invoice.status == "queued")
             .order_by(Invoice.id.asc())
-            .first()
+            .limit(limit)
+            .with_for_update(skip_locked=True)
         )
-        if not inv:
-            return None
-        inv.status = "processing"
+        invoices = db.execute(
+            update(Invoice)
+            .where(Invoice.id.in_(claim_ids))
+            .values(status="processing")
+            .returning(Invoice)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        # отвязываем ДО commit(): commit помечает атрибуты объектов в
+        # сессии протухшими (expire_on_commit=True по умолчанию), и уже
+        # отвязанный инвойс падал бы с DetachedInstanceError на первом
+        # же обращении к invoice.id
+        db.expunge_all()
         db.commit()
-        db.refresh(inv)
-        return inv
+        return list(invoices)
     finally:
         db.close()
 
 
+def get_next_invoice() -> Optional[Invoice]:
+    """Совместимость: забрать один инвойс."""
+    invoices = get_next_invoices(1)
+    return invoices[0] if invoices else None
+
+
 # ============================================================
 #   HIGHLIGHT CAPTCHA
 # ============================================================
@@ -216,70 +472,39 @@ async def highlight_captcha_tab(page: Page, invoice: Invoice) -> None:
         pass
 
     try:
-        await page.evaluate(
-            """
-            (id) => {
-                const elId = 'aideon-captcha-banner';
-                let el = document.getElementById(elId);
-                if (!el) {
-                    el = document.createElement('div');
-                    el.id = elId;
-                    el.style.position = 'fixed';
-                    el.style.top = '0';
-                    el.style.left = '0';
-                    el.style.right = '0';
-                    el.style.zIndex = '999999';
-                    el.style.background = '#ff3333';
-                    el.style.color = '#fff';
-                    el.style.padding = '10px 16px';
-                    el.style.fontSize = '16px';
-                    el.style.fontFamily = 'sans-serif';
-                    el.style.textAlign = 'center';
-                    document.body.appendChild(el);
-                }
-                el.textContent = 'Aideon Agent: пройди капчу для инвойса ' + id;
-            }
-            """,
-            invoice.id,
-        )
-        print(f"[CAPTCHA] Вкладка invoice={invoice.id} подсвечена.")
+        await page.evaluate("(id) => window.__aideonShowBanner(id)", invoice.id)
+        log.info(f"[CAPTCHA] Вкладка invoice={invoice.id} подсвечена.")
     except Exception as e:
-        print(f"[CAPTCHA] Ошибка показа баннера: {e}")
+        log.error(f"[CAPTCHA] Ошибка показа баннера: {e}")
 
 
 # ============================================================
 #   PROCESS INVOICE
 # ============================================================
 
-async def process_invoice(context: BrowserContext, invoice: Invoice) -> None:
-    print(f"[PROCESS] Старт обработки invoice={invoice.id}")
-    page = await context.new_page()
-    print(f"[TAB] Открыта новая вкладка для invoice={invoice.id}")
-
-    # --------------------------------------------
-    # НОВОЕ: инжект Aideon Helper JS в вкладку
-    # --------------------------------------------
-    try:
-        if HELPER_JS_PATH.exists():
-            helper_js_code = HELPER_JS_PATH.read_text(encoding="utf-8")
-            await page.add_init_script(helper_js_code)
-            print(f"[AIDEON-HELPER] aideon_helper.js инжектирован для invoice={invoice.id}")
-        else:
-            print(f"[AIDEON-HELPER] WARN: файл {HELPER_JS_PATH} не найден, helper не подключён")
-    except Exception as e:
-        print(f"[AIDEON-HELPER] Ошибка инжекта helper JS: {e}")
+async def process_invoice(pool: ContextPool, invoice: Invoice) -> None:
+    log.info(f"[PROCESS] Старт обработки invoice={invoice.id}")
+    context = await pool.acquire()
+    page: Optional[Page] = None
 
     db = SessionLocal()
     try:
+        # new_page — внутри try: если контекст умер (краш браузера /
+        # прокси), он не должен навсегда съесть слот пула
+        page = await context.new_page()
+        log.debug(f"[TAB] Открыта новая вкладка для invoice={invoice.id}")
+
+        # helper JS уже заинжектирован init-скриптом контекста (см. new_agent_context)
+
         inv_db = db.query(Invoice).filter(Invoice.id == invoice.id).first()
         if not inv_db:
-            print(f"[ERROR] В БД не найден invoice={invoice.id}.")
+            log.info(f"[ERROR] В БД не найден invoice={invoice.id}.")
             return
 
         _mark_session_status("working", f"Processing invoice {invoice.id}")
 
         base_url = MULTITRANSFER_BASE_URL or "https://multitransfer.ru/transfer/uzbekistan"
-        print(f"[OPEN] Открываю: {base_url}")
+        log.info(f"[OPEN] Открываю: {base_url}")
         await page.goto(base_url)
 
         # STEP 1
@@ -290,53 +515,90 @@ async def process_invoice(context: BrowserContext, invoice: Invoice) -> None:
 
         # STEP 3
         await step3_fill_recipient_and_sender(page, inv_db)
-        print("[FLOW] Шаг 3 завершён — ожидается капча.")
+        log.info("[FLOW] Шаг 3 завершён — ожидается капча.")
 
-        inv_db.status = "waiting_captcha"
-        inv_db.error_message = None
-        db.commit()
-        print(f"[FLOW] Invoice {inv_db.id} → waiting_captcha")
+        # Маркер waiting_captcha — чисто витринный статус для админки:
+        # его commit/fsync не должен держать event loop и старт step4
+        # (финальный статус step4 запишет сильно позже, после капчи).
+        _spawn_bg(asyncio.to_thread(_flush_waiting_captcha, inv_db.id))
+        log.info(f"[FLOW] Invoice {inv_db.id} → waiting_captcha")
 
         await highlight_captcha_tab(page, inv_db)
 
         # STEP 4
         deeplink = await step4_wait_for_deeplink(page, inv_db)
-        print(f"[DONE] STEP4 deeplink: {deeplink!r}")
+        log.info(f"[DONE] STEP4 deeplink: {deeplink!r}")
 
         _mark_session_status("ok", f"Processed invoice {inv_db.id}")
 
         if DEBUG_KEEP_TABS:
-            print(f"[TAB] Вкладка invoice={invoice.id} оставлена открытой (DEBUG_KEEP_TABS).")
+            log.debug(f"[TAB] Вкладка invoice={invoice.id} оставлена открытой (DEBUG_KEEP_TABS).")
         else:
             try:
                 await page.close()
-                print(f"[TAB] Закрыта вкладка invoice={invoice.id}")
+                log.debug(f"[TAB] Закрыта вкладка invoice={invoice.id}")
             except Exception:
                 pass
 
-        print(f"[PROCESS] Завершение invoice={invoice.id} (успех).")
+        log.info(f"[PROCESS] Завершение invoice={invoice.id} (успех).")
 
     except Exception as e:
         error_msg = str(e)
-        print(f"[ERROR] Ошибка invoice={invoice.id}: {error_msg}")
+        log.error(f"[ERROR] Ошибка invoice={invoice.id}: {error_msg}")
 
         if not error_msg.startswith("[STEP4]"):
-            _finalize_invoice_error_any_step(invoice.id, error_msg)
+            # статус пишем через уже открытую сессию этого инвойса;
+            # вебхук не задерживает обработку — уходит фоновой задачей
+            payload = _finalize_invoice_error_db(db, invoice.id, error_msg)
+            _spawn_bg(_post_error_webhook(payload))
 
         _mark_session_status("error", error_msg)
 
         if DEBUG_KEEP_TABS:
-            print(f"[TAB] Вкладка invoice={invoice.id} НЕ закрыта из-за ошибки (DEBUG_KEEP_TABS).")
-        else:
+            log.debug(f"[TAB] Вкладка invoice={invoice.id} НЕ закрыта из-за ошибки (DEBUG_KEEP_TABS).")
+        elif page is not None:
             try:
                 await page.close()
-                print(f"[TAB] Закрыта вкладка invoice={invoice.id} (ошибка).")
+                log.debug(f"[TAB] Закрыта вкладка invoice={invoice.id} (ошибка).")
             except Exception:
                 pass
 
-        print(f"[PROCESS] Завершение invoice={invoice.id} (ошибка).")
+        log.info(f"[PROCESS] Завершение invoice={invoice.id} (ошибка).")
     finally:
         db.close()
+        if page is None:
+            # вкладка так и не открылась — контекст мёртв, возвращать
+            # его в очередь нельзя (следующий воркер получит тот же
+            # труп); выбрасываем, acquire() создаст свежий
+            pool.discard(context)
+        else:
+            pool.release(context)
+
+
+# ============================================================
+#   WAKEUP ГЛАВНОГО ЦИКЛА
+# ============================================================
+
+# Событие «появилась работа»: ставится при завершении задач и из
+# notify_new_invoice(). Цикл спит на нём вместо слепого поллинга,
+# таймаут оставляем как страховочный опрос БД.
+_new_work = asyncio.Event()
+
+
+def notify_new_invoice() -> None:
+    """
+    Будит главный цикл агента (для in-process постановки инвойсов,
+    например из embedded-API или DB NOTIFY-хука).
+    """
+    _new_work.set()
+
+
+async def _wait_for_new_work(timeout: float) -> None:
+    try:
+        await asyncio.wait_for(_new_work.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    _new_work.clear()
 
 
 # ============================================================
@@ -344,77 +606,104 @@ async def process_invoice(context: BrowserContext, invoice: Invoice) -> None:
 # ============================================================
 
 async def run_agent():
+    try:
+        await _run_agent_loop()
+    finally:
+        # даём фоновым задачам (вебхуки в полёте и т.п.) дойти до
+        # конца, прежде чем закрывать общий HTTP-клиент
+        if _bg_tasks:
+            await asyncio.wait(set(_bg_tasks), timeout=10)
+        await _http.aclose()
+
+
+async def _run_agent_loop():
+    flusher = asyncio.create_task(_status_flusher(), name="status-flusher")
+    try:
+        await _agent_main()
+    finally:
+        flusher.cancel()
+
+
+async def _agent_main():
     async with async_playwright() as play:
-        context = await open_context(play)
+        browser = await open_browser(play)
+
+        # пул контекстов под параллельные инвойсы + отдельный контекст
+        # для базовой вкладки
+        pool = ContextPool(browser, MAX_CONCURRENT_INVOICES)
+        base_context = await new_agent_context(browser)
 
         base_url = MULTITRANSFER_BASE_URL or "https://multitransfer.ru/transfer/uzbekistan"
-        print(f"[AGENT] Открываю базовую вкладку: {base_url}")
+        log.info(f"[AGENT] Открываю базовую вкладку: {base_url}")
         try:
-            base_page = await context.new_page()
-
-            # Инжект helper JS и в базовую форму (для будущего использования)
-            try:
-                if HELPER_JS_PATH.exists():
-                    helper_js_code = HELPER_JS_PATH.read_text(encoding="utf-8")
-                    await base_page.add_init_script(helper_js_code)
-                    print("[AIDEON-HELPER] helper JS инжектирован в базовую вкладку")
-                else:
-                    print(f"[AIDEON-HELPER] WARN: файл {HELPER_JS_PATH} не найден для базовой вкладки")
-            except Exception as e:
-                print(f"[AIDEON-HELPER] Ошибка инжекта helper JS в базовую вкладку: {e}")
+            base_page = await base_context.new_page()
 
+            # helper JS инжектируется init-скриптом контекста
             await base_page.goto(base_url)
             _mark_session_status("ok", "Base form opened")
         except Exception as e:
-            print(f"[AGENT] ⚠ Ошибка открытия базовой формы: {e}")
+            log.error(f"[AGENT] ⚠ Ошибка открытия базовой формы: {e}")
             _mark_session_status("error", str(e))
 
-        print("[AGENT] Запущен. Жду queued-инвойсы...")
-
-        semaphore = asyncio.Semaphore(MAX_CONCURRENT_INVOICES)
-        tasks: set[asyncio.Task] = set()
-        last_idle_log: Optional[datetime] = None
-
-        async def _runner(inv: Invoice):
-            print(f"[RUNNER] Жду слот для invoice={inv.id}")
-            async with semaphore:
-                print(f"[RUNNER] Слот получен → invoice={inv.id}")
-                await process_invoice(context, inv)
-            print(f"[RUNNER] Слот освобождён → invoice={inv.id}")
-
-        while True:
-            done = {t for t in tasks if t.done()}
-            if done:
-                print(f"[AGENT] Завершено задач: {len(done)}")
-                tasks -= done
-
-            found_new = False
-
-            while len(tasks) < MAX_CONCURRENT_INVOICES:
-                invoice = get_next_invoice()
-                if not invoice:
-                    break
-
-                found_new = True
-                print(f"[QUEUE] Взяли invoice={invoice.id} в обработку")
-                t = asyncio.create_task(_runner(invoice), name=f"invoice-{invoice.id}")
-                tasks.add(t)
-
-            if tasks:
-                active = [t.get_name() for t in tasks]
-                print(f"[AGENT] Активных задач: {len(tasks)} / {MAX_CONCURRENT_INVOICES} → {active}")
-                _mark_session_status("working", f"{len(tasks)} active")
-                await asyncio.sleep(1)
-                continue
-
-            now = datetime.utcnow()
-            if not found_new:
-                if not last_idle_log or (now - last_idle_log).total_seconds() >= 60:
-                    print("[AGENT] Idle. Нет queued-инвойсов.")
-                    last_idle_log = now
-
-            _mark_session_status("ok", "Idle")
-            await asyncio.sleep(5)
+        log.info("[AGENT] Запущен. Жду queued-инвойсы...")
+
+        # Фиксированный пул воркеров вместо семафора + task на каждый
+        # инвойс: Task/Handle-объекты создаются один раз на весь запуск,
+        # воркеры просто тянут инвойсы из внутренней очереди.
+        work_q: asyncio.Queue[Invoice] = asyncio.Queue(
+            maxsize=MAX_CONCURRENT_INVOICES
+        )
+        active_workers = 0
+
+        async def _worker(n: int) -> None:
+            nonlocal active_workers
+            while True:
+                inv = await work_q.get()
+                active_workers += 1
+                log.debug(f"[WORKER-{n}] → invoice={inv.id}")
+                try:
+                    await process_invoice(pool, inv)
+                except Exception as e:
+                    log.error(f"[WORKER-{n}] Необработанная ошибка invoice={inv.id}: {e}")
+                finally:
+                    active_workers -= 1
+                    work_q.task_done()
+                    # освободился слот — продюсер может добрать очередь
+                    _new_work.set()
+                log.debug(f"[WORKER-{n}] Слот освобождён (invoice={inv.id})")
+
+        workers = [
+            asyncio.create_task(_worker(n), name=f"invoice-worker-{n}")
+            for n in range(MAX_CONCURRENT_INVOICES)
+        ]
+
+        try:
+            while True:
+                # claim'им из БД не больше, чем реально свободно слотов,
+                # чтобы инвойсы не висели в processing до своего воркера
+                free_slots = MAX_CONCURRENT_INVOICES - active_workers - work_q.qsize()
+                new_invoices = get_next_invoices(free_slots) if free_slots > 0 else []
+
+                for invoice in new_invoices:
+                    log.info(f"[QUEUE] Взяли invoice={invoice.id} в обработку")
+                    work_q.put_nowait(invoice)
+
+                busy = active_workers + work_q.qsize()
+                if busy:
+                    log.info(f"[AGENT] Активных инвойсов: {busy} / {MAX_CONCURRENT_INVOICES}")
+                    _mark_session_status("working", f"{busy} active")
+                    await _wait_for_new_work(timeout=1)
+                    continue
+
+                # в idle цикл просыпается не чаще страховочного таймаута,
+                # отдельный rate-limit для лога не нужен
+                log.info("[AGENT] Idle. Нет queued-инвойсов.")
+                _mark_session_status("ok", "Idle")
+                # спим до сигнала о новой работе; таймаут — страховочный опрос БД
+                await _wait_for_new_work(timeout=30)
+        finally:
+            for w in workers:
+                w.cancel()
 
 
 if __name__ == "__main__":
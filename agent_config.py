@@ -47,6 +47,17 @@ DEFAULT_USER_AGENT = (
 )
 
 
+# ----------------------
+# BROWSER
+# ----------------------
+# Headless-режим Chromium. По умолчанию False: капчу сейчас проходит
+# человек прямо во вкладке инвойса, поэтому окно должно быть видно.
+# При автоматическом решении капчи (captcha_solver) можно включить
+# True — headless-страницы заметно дешевле по памяти и CPU
+# (нет композитора) при MAX_CONCURRENT_INVOICES вкладках.
+AGENT_HEADLESS: bool = False
+
+
 # ----------------------
 # CONCURRENCY (параллельные агенты)
 # ----------------------
@@ -85,11 +85,43 @@ class AIPlanner:
     @staticmethod
     def _extract_json_array(text: str) -> Optional[str]:
         """
-        Вырезает первый JSON-массив из текста.
+        Вырезает первый СБАЛАНСИРОВАННЫЙ JSON-массив из текста одним
+        проходом со счётчиком глубины скобок.
         Например: 'Вот ответ: [ {...}, {...} ] Удачи!' -> '[ {...}, {...} ]'
+
+        В отличие от find('[') + rfind(']'), не ломается, когда модель
+        выводит несколько массивов или markdown после ответа, и учитывает
+        ']' внутри строковых литералов.
         """
-        start = text.find("[")
-        end = text.rfind("]")
-        if start == -1 or end == -1 or end <= start:
-            return None
-        return text[start : end + 1]
\ No newline at end of file
+        start = -1
+        depth = 0
+        in_string = False
+        escape = False
+
+        for i, ch in enumerate(text):
+            if in_string:
+                if escape:
+                    escape = False
+                elif ch == "\\":
+                    escape = True
+                elif ch == '"':
+                    in_string = False
+                continue
+            if ch == '"':
+                if start != -1:
+                    in_string = True
+            elif ch == "[":
+                if start == -1:
+                    start = i
+                depth += 1
+            elif ch == "]" and start != -1:
+                depth -= 1
+                if depth == 0:
+                    return text[start : i + 1]
+
+        # несбалансированный ответ — пробуем старую грубую вырезку
+        if start != -1:
+            end = text.rfind("]")
+            if end > start:
+                return text[start : end + 1]
+        return None
\ No newline at end of file
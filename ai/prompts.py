@@ -52,6 +52,8 @@ def build_planner_prompt(
         },
     }
 
+    # компактная сериализация: отступы вчетверо раздувают промпт
+    # (платные токены + байты по сети), модели они не нужны
     return system_instructions + "\nДанные пользователя (JSON):\n" + json.dumps(
-        user_payload, ensure_ascii=False, indent=2
+        user_payload, ensure_ascii=False, separators=(",", ":")
     ) + "\n\nВерни только JSON-массив действий."
\ No newline at end of file
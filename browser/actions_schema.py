@@ -31,7 +31,10 @@ class ScanResultDict(TypedDict):
     elements: List[ScanElementDict]
 
 
-@dataclass
+# slots=True: планировщик создаёт эти объекты на каждый экшен LLM-цикла,
+# слоты убирают per-instance __dict__ (~сотни байт и лишний хеш-лукап
+# на каждое обращение к атрибуту)
+@dataclass(slots=True)
 class TargetRef:
     """Ссылка на элемент, с которым нужно что-то сделать."""
     id: Optional[str] = None
@@ -60,7 +63,7 @@ class TargetRef:
         }
 
 
-@dataclass
+@dataclass(slots=True)
 class Action:
     """Одно действие агента на странице."""
     type: ActionType
@@ -91,7 +94,21 @@ class Action:
         }
 
 
-@dataclass
+# Поля, которые уходят в LLM в компактном представлении скана
+_COMPACT_KEYS = (
+    "id",
+    "role",
+    "tag",
+    "name",
+    "text",
+    "placeholder",
+    "type",
+    "visible",
+    "cssSelector",
+)
+
+
+@dataclass(slots=True)
 class ScanResult:
     """Результат scan() от AideonHelper JS."""
     url: str
@@ -108,24 +125,11 @@ class ScanResult:
 
     def to_compact_dict(self, max_elements: int = 120) -> Dict[str, Any]:
         """Компактное представление для передачи в LLM."""
-        els = self.elements[:max_elements]
-        compact_elements: List[Dict[str, Any]] = []
-        for e in els:
-            compact_elements.append(
-                {
-                    "id": e.get("id"),
-                    "role": e.get("role"),
-                    "tag": e.get("tag"),
-                    "name": e.get("name"),
-                    "text": e.get("text"),
-                    "placeholder": e.get("placeholder"),
-                    "type": e.get("type"),
-                    "visible": e.get("visible"),
-                    "cssSelector": e.get("cssSelector"),
-                }
-            )
         return {
             "url": self.url,
             "title": self.title,
-            "elements": compact_elements,
+            "elements": [
+                {k: e.get(k) for k in _COMPACT_KEYS}
+                for e in self.elements[:max_elements]
+            ],
         }
\ No newline at end of file
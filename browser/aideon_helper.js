@@ -1,6 +1,6 @@
 // aideon_agent/browser/aideon_helper.js
 // Универсальный JS-хелпер, который живет внутри страницы.
-// Даёт API: window.AideonHelper.scan/perform/getState
+// Даёт API: window.AideonHelper.scan/perform/performMany/getState
 
 (function () {
   if (window.AideonHelper) return;
@@ -261,6 +261,28 @@
     }
   }
 
+  async function performMany(actions, opts) {
+    // Пакетное выполнение: один вызов из Playwright вместо RPC на
+    // каждое действие. Между действиями ждём кадр отрисовки (два rAF)
+    // вместо фиксированной паузы — UI успевает обработать input/change.
+    const results = [];
+    if (!Array.isArray(actions)) return results;
+    if (opts && opts.parallel) {
+      // независимые поля (fill/select по разным целям): одна волна
+      // Promise.all без покадрового ожидания между действиями
+      return Promise.all(actions.map((a) => perform(a)));
+    }
+    for (const action of actions) {
+      results.push(await perform(action));
+      if (action && action.type !== "wait") {
+        await new Promise((res) =>
+          requestAnimationFrame(() => requestAnimationFrame(res))
+        );
+      }
+    }
+    return results;
+  }
+
   function getState() {
     // Общий state по умолчанию. Под конкретный сайт можно доопределять.
     const balanceEl =
@@ -278,6 +300,7 @@
   window.AideonHelper = {
     scan,
     perform,
+    performMany,
     getState,
   };
 })();
\ No newline at end of file
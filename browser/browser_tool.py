@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import json
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
@@ -10,10 +11,104 @@ from playwright.async_api import async_playwright, Page
 from aideon_agent.browser.actions_schema import Action, ScanResult
 
 
+@lru_cache(maxsize=8)
+def _load_helper_js(path: str) -> str:
+    """
+    Читает helper JS один раз на путь: BrowserTool создаётся на каждый
+    запуск браузера, а файл не меняется — кэш убирает повторный
+    syscall + UTF-8 декодирование из start().
+    """
+    return Path(path).read_text(encoding="utf-8")
+
+
+class BrowserPool:
+    """
+    Пул тёплых BrowserContext под последовательные задачи BrowserTool.
+
+    Холодный запуск chromium стоит 0.5-2с на каждый start(); пул
+    запускает браузер один раз, helper JS инжектится init-скриптом
+    на уровне контекста при его создании, а release() закрывает только
+    страницу и возвращает контекст в список простаивающих.
+    """
+
+    def __init__(
+        self,
+        helper_js_path: str,
+        headless: bool = True,
+        proxy: Optional[Dict[str, str]] = None,
+        slow_mo: Optional[int] = None,
+    ):
+        self.helper_js_path = helper_js_path
+        self.headless = headless
+        self.proxy = proxy
+        self.slow_mo = slow_mo
+
+        self._pw = None
+        self._browser = None
+        self._idle: List[Any] = []
+
+    async def _ensure_browser(self) -> None:
+        if self._browser:
+            return
+        self._pw = await async_playwright().start()
+
+        launch_kwargs: Dict[str, Any] = {"headless": self.headless}
+        if self.proxy:
+            launch_kwargs["proxy"] = {
+                "server": self.proxy["server"],
+                "username": self.proxy.get("username") or None,
+                "password": self.proxy.get("password") or None,
+            }
+        if self.slow_mo:
+            launch_kwargs["slow_mo"] = self.slow_mo
+
+        self._browser = await self._pw.chromium.launch(**launch_kwargs)
+
+    async def acquire(self):
+        """Выдаёт (context, page): тёплый контекст из пула или новый."""
+        await self._ensure_browser()
+        if self._idle:
+            context = self._idle.pop()
+        else:
+            context = await self._browser.new_context()
+            # один инжект на контекст — тёплые контексты не платят заново
+            await context.add_init_script(_load_helper_js(self.helper_js_path))
+        page = await context.new_page()
+        return context, page
+
+    async def release(self, context, page) -> None:
+        """Закрывает страницу и возвращает контекст в пул."""
+        try:
+            if page:
+                await page.close()
+        except Exception:
+            pass
+        if context:
+            self._idle.append(context)
+
+    async def close(self) -> None:
+        for context in self._idle:
+            try:
+                await context.close()
+            except Exception:
+                pass
+        self._idle.clear()
+
+        try:
+            if self._browser:
+                await self._browser.close()
+        finally:
+            self._browser = None
+
+        if self._pw:
+            await self._pw.stop()
+            self._pw = None
+
+
 class BrowserTool:
     """
     Обёртка над Playwright для Aideon Agent:
-    - старт/стоп браузера
+    - старт/стоп браузера (или аренда тёплого контекста из BrowserPool)
     - инжект aideon_helper.js
     - scan() / perform() / get_state() / screenshot()
     """
@@ -25,6 +120,7 @@ class BrowserTool:
         proxy: Optional[Dict[str, str]] = None,
         slow_mo: Optional[int] = None,
         logger: Any = None,
+        pool: Optional[BrowserPool] = None,
     ):
         """
         proxy пример:
@@ -39,10 +135,12 @@ class BrowserTool:
         self.proxy = proxy
         self.slow_mo = slow_mo
         self.logger = logger
+        self.pool = pool
 
         self._pw = None
         self._browser = None
         self._context = None
+        self._cdp = None
         self.page: Optional[Page] = None
 
     async def __aenter__(self) -> "BrowserTool":
@@ -53,6 +151,14 @@ class BrowserTool:
         await self.close()
 
     async def start(self) -> None:
+        if self.pool:
+            # тёплый контекст: без запуска браузера и повторного инжекта
+            self._context, self.page = await self.pool.acquire()
+            await self._open_cdp()
+            if self.logger:
+                self.logger.info("[BrowserTool] Acquired warm context from pool")
+            return
+
         if self.logger:
             self.logger.info("[BrowserTool] Starting browser...")
 
@@ -74,12 +180,44 @@ class BrowserTool:
         self._context = await self._browser.new_context()
         self.page = await self._context.new_page()
 
-        helper_js = Path(self.helper_js_path).read_text(encoding="utf-8")
+        helper_js = _load_helper_js(self.helper_js_path)
         await self.page.add_init_script(helper_js)
+        await self._open_cdp()
 
         if self.logger:
             self.logger.info("[BrowserTool] Browser started, helper injected")
 
+    async def _open_cdp(self) -> None:
+        """
+        Долгоживущая CDP-сессия для горячих evaluate без аргументов
+        (scan/getState зовутся в каждом цикле планировщика): прямой
+        Runtime.evaluate обходит слой маршалинга Playwright.
+        """
+        try:
+            self._cdp = await self._context.new_cdp_session(self.page)
+        except Exception as e:
+            self._cdp = None
+            if self.logger:
+                self.logger.warning(f"[BrowserTool] CDP session unavailable: {e}")
+
+    async def _eval(self, expression: str) -> Any:
+        """Выполняет JS-выражение через CDP, с откатом на page.evaluate."""
+        if self._cdp:
+            try:
+                res = await self._cdp.send(
+                    "Runtime.evaluate",
+                    {
+                        "expression": expression,
+                        "returnByValue": True,
+                        "awaitPromise": True,
+                    },
+                )
+                if "exceptionDetails" not in res:
+                    return res.get("result", {}).get("value")
+            except Exception:
+                pass
+        return await self.page.evaluate(expression)
+
     async def goto(self, url: str, wait_until: str = "networkidle", timeout: int = 60000) -> None:
         if not self.page:
             raise RuntimeError("BrowserTool: page is not initialized")
@@ -94,9 +232,7 @@ class BrowserTool:
         if self.logger:
             self.logger.debug("[BrowserTool] SCAN")
 
-        data = await self.page.evaluate(
-            "() => window.AideonHelper && window.AideonHelper.scan()"
-        )
+        data = await self._eval("window.AideonHelper && window.AideonHelper.scan()")
         if not data:
             raise RuntimeError("AideonHelper.scan() returned nothing")
 
@@ -117,6 +253,55 @@ class BrowserTool:
         return res or {"ok": False, "error": "No response from helper"}
 
     async def perform_many(self, actions: List[Action]) -> List[Dict[str, Any]]:
+        """
+        Пакетное выполнение: сериализуем все действия один раз и гоняем
+        их одним evaluate через AideonHelper.performMany — один RPC
+        round-trip на весь батч вместо RPC + 200мс паузы на действие.
+        """
+        if not self.page:
+            raise RuntimeError("BrowserTool: page is not initialized")
+        if not actions:
+            return []
+
+        payload = [a.to_dict() for a in actions]
+        parallel = self._can_parallelize(actions)
+        if self.logger:
+            self.logger.info(
+                f"[BrowserTool] PERFORM_MANY ({len(payload)} actions, parallel={parallel})"
+            )
+
+        res = await self.page.evaluate(
+            "(args) => (window.AideonHelper && window.AideonHelper.performMany)"
+            " ? window.AideonHelper.performMany(args.actions, {parallel: args.parallel})"
+            " : null",
+            {"actions": payload, "parallel": parallel},
+        )
+        if res is None:
+            # старый helper без performMany — деградируем в поштучный режим
+            return await self.perform_many_sequential(actions)
+        return res
+
+    @staticmethod
+    def _can_parallelize(actions: List[Action]) -> bool:
+        """
+        fill/select по попарно разным целям не зависят друг от друга —
+        такой батч можно выполнить в браузере одной волной Promise.all.
+        click и wait меняют состояние страницы, их оставляем строго
+        последовательными.
+        """
+        seen_refs = set()
+        for a in actions:
+            if a.type not in ("fill", "select") or a.target is None:
+                return False
+            ref = (a.target.id, a.target.cssSelector, a.target.text,
+                   a.target.role, a.target.name)
+            if ref in seen_refs:
+                return False
+            seen_refs.add(ref)
+        return True
+
+    async def perform_many_sequential(self, actions: List[Action]) -> List[Dict[str, Any]]:
+        """Поштучный fallback (RPC на действие + пауза для обновления UI)."""
         results: List[Dict[str, Any]] = []
         for a in actions:
             res = await self.perform(a)
@@ -133,20 +318,46 @@ class BrowserTool:
         if self.logger:
             self.logger.debug("[BrowserTool] GET_STATE")
 
-        res = await self.page.evaluate(
-            "() => window.AideonHelper && window.AideonHelper.getState()"
-        )
+        res = await self._eval("window.AideonHelper && window.AideonHelper.getState()")
         return res or {}
 
-    async def screenshot(self, path: str, full_page: bool = True) -> None:
+    async def screenshot(
+        self,
+        path: str,
+        full_page: bool = True,
+        image_type: str = "png",
+        quality: Optional[int] = None,
+    ) -> None:
+        """
+        Скриншот страницы. Для full_page-PNG это мегабайты: берём байты
+        в память и пишем файл одним write() вместо побуферной записи
+        через пайп Playwright. image_type='jpeg' (quality по умолчанию 80)
+        режет размер в 5-10 раз, когда PNG не обязателен.
+        """
         if not self.page:
             raise RuntimeError("BrowserTool: page is not initialized")
 
         if self.logger:
             self.logger.info(f"[BrowserTool] SCREENSHOT -> {path}")
-        await self.page.screenshot(path=path, full_page=full_page)
+
+        kwargs: Dict[str, Any] = {"full_page": full_page, "type": image_type}
+        if image_type == "jpeg":
+            kwargs["quality"] = 80 if quality is None else quality
+        buf = await self.page.screenshot(**kwargs)
+
+        with open(path, "wb") as f:
+            f.write(buf)
 
     async def close(self) -> None:
+        if self.pool:
+            await self.pool.release(self._context, self.page)
+            self._context = None
+            self._cdp = None  # сессия умирает вместе со страницей
+            self.page = None
+            if self.logger:
+                self.logger.info("[BrowserTool] Context returned to pool")
+            return
+
         if self.logger:
             self.logger.info("[BrowserTool] Closing browser...")
         try:
@@ -165,6 +376,7 @@ class BrowserTool:
             await self._pw.stop()
             self._pw = None
 
+        self._cdp = None
         self.page = None
         if self.logger:
             self.logger.info("[BrowserTool] Closed")
\ No newline at end of file
@@ -1,7 +1,10 @@
 # captcha_manager.py
 from __future__ import annotations
 
+import asyncio
+import gzip
 import os
+import re
 from datetime import datetime
 from enum import Enum
 from typing import Optional, Union
@@ -33,33 +36,121 @@ TWOCAPTCHA_KEY = os.getenv("TWOCAPTCHA_KEY", "")
 
 DEBUG_DIR_CAPTCHA = "debug/multitransfer_captcha"
 
+# Дампы DOM на каждый шаг капчи — чисто отладочный инструмент:
+# в проде они стоят page.content() + блокирующую запись на каждый
+# вызов, поэтому по умолчанию выключены.
+DEBUG_CAPTCHA_DUMPS = os.getenv("DEBUG_CAPTCHA_DUMPS", "0") == "1"
+
+_debug_dir_ready = False
+
 
 def _ensure_captcha_debug_dir() -> None:
-    """Создаём папку для дампов капча-шага, если её нет."""
+    """Создаём папку для дампов капча-шага, если её нет (один раз)."""
+    global _debug_dir_ready
+    if _debug_dir_ready:
+        return
     try:
         os.makedirs(DEBUG_DIR_CAPTCHA, exist_ok=True)
+        _debug_dir_ready = True
     except Exception as e:
         print(f"[CAPTCHA-DEBUG] Не удалось создать папку {DEBUG_DIR_CAPTCHA}: {e}")
 
 
+def _write_gzip_html(path: str, html: str) -> None:
+    with open(path, "wb") as f:
+        f.write(gzip.compress(html.encode("utf-8")))
+
+
 async def _save_captcha_html(page: Page, label: str) -> None:
     """
-    Сохраняем HTML капча-шага:
-    debug/multitransfer_captcha/{label}_captcha_YYYYMMDD_HHMMSS.html
+    Сохраняем HTML капча-шага (только при DEBUG_CAPTCHA_DUMPS=1):
+    debug/multitransfer_captcha/{label}_captcha_YYYYMMDD_HHMMSS.html.gz
+
+    Запись (gzip + файл) уходит в тредпул, чтобы не стопорить event loop.
     """
+    if not DEBUG_CAPTCHA_DUMPS:
+        return
+
     _ensure_captcha_debug_dir()
     ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    html_path = os.path.join(DEBUG_DIR_CAPTCHA, f"{label}_captcha_{ts}.html")
+    html_path = os.path.join(DEBUG_DIR_CAPTCHA, f"{label}_captcha_{ts}.html.gz")
 
     try:
-        html = await page.content()
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(html)
+        # page.content() ходит через сериализатор протокола Blink и под
+        # нагрузкой растягивается до десятков секунд; outerHTML через
+        # evaluate стабильно быстрее и для дампа эквивалентен
+        html = await page.evaluate("() => document.documentElement.outerHTML")
+        await asyncio.to_thread(_write_gzip_html, html_path, html)
         print(f"[CAPTCHA-DEBUG] HTML страницы сохранён в {html_path}")
     except Exception as e:
         print(f"[CAPTCHA-DEBUG] Не удалось сохранить HTML: {e}")
 
 
+# ============================================================
+# ДЕТЕКТОР КАПЧИ (один round-trip в браузер)
+# ============================================================
+
+# Тексты вокруг капчи / проверки безопасности (регистр не важен —
+# матчим одним case-insensitive regex'ом)
+_CAPTCHA_TEXTS = [
+    "капча",
+    "код с картинки",
+    "введите код",
+    "я не робот",
+    "не робот",
+    "подтвердите, что вы человек",
+    "проверка безопасности",
+]
+
+# Один скомпилированный паттерн вместо поштучных includes: RegExp
+# компилируется в браузере один раз на вызов и сканирует innerText
+# за один проход по всем альтернативам сразу.
+_CAPTCHA_TEXT_PATTERN = "|".join(re.escape(t) for t in _CAPTCHA_TEXTS)
+
+# Объединённый селектор всех DOM-индикаторов капчи — для
+# wait_for_selector, который просыпается в момент появления узла
+_SEL_CAPTCHA_ANY = (
+    "iframe[src*='captcha'], iframe[src*='recaptcha'], "
+    "iframe[src*='hcaptcha'], iframe[src*='turnstile'], "
+    "img[src*='captcha'], img[src*='capcha'], "
+    "canvas[id*='captcha'], canvas[class*='captcha'], "
+    "div[id*='captcha'], div[class*='captcha'], "
+    "input[name*='captcha'], input[id*='captcha']"
+)
+
+# Селекторы кликабельной части капчи (модалка / чекбокс reCAPTCHA) —
+# константы модуля, чтобы не пересобирать строки на каждый вызов
+_SEL_MODAL = (
+    "div[role='dialog'], div[aria-modal='true'], "
+    "div[class*='modal'], div[class*='popup'], div[class*='dialog']"
+)
+_SEL_RECAPTCHA_BOX = "span[role='checkbox'], div[role='checkbox']"
+
+# Все селекторы и текстовые признаки проверяются ОДНИМ page.evaluate:
+# каждый locator.count()/get_by_text().count() — отдельный CDP round-trip
+# (а их тут было ~15 на проверку, по миллисекундам на каждый).
+_HAS_CAPTCHA_JS = """
+(pattern) => {
+    const sels = [
+        "iframe[src*='captcha']", "iframe[src*='recaptcha']",
+        "iframe[src*='hcaptcha']", "iframe[src*='turnstile']",
+        "img[src*='captcha']", "img[src*='capcha']",
+        "img[alt*='captcha']", "img[alt*='capcha']",
+        "canvas[id*='captcha']", "canvas[class*='captcha']",
+        "div[id*='captcha']", "div[class*='captcha']",
+        "input[name*='captcha']", "input[id*='captcha']",
+        "input[aria-label*='captcha']"
+    ];
+    for (const s of sels) {
+        if (document.querySelector(s)) return true;
+    }
+    // тексты (покрывает и модалки — их текст тоже в body.innerText)
+    const body = document.body ? document.body.innerText : '';
+    return new RegExp(pattern, 'i').test(body);
+}
+"""
+
+
 # ============================================================
 # ГЛАВНАЯ ФУНКЦИЯ ДЛЯ АГЕНТА
 # ============================================================
@@ -86,9 +177,10 @@ async def process_captcha_if_needed(page: Page) -> bool:
     await _save_captcha_html(page, "before_check")
 
     async def _has_captcha() -> bool:
-        """Хитрая проверка наличия капчи по разным признакам (включая модалку)."""
+        """Проверка наличия капчи одним evaluate (+ URL-ы фреймов из Python)."""
 
-        # --- iframe-ы с captcha/recaptcha/hcaptcha/turnstile ---
+        # кросс-доменные iframe из DOM не прочитать — их URL-ы смотрим
+        # здесь (page.frames — локальный список, без round-trip)
         try:
             for fr in page.frames:
                 url = (fr.url or "").lower()
@@ -97,72 +189,26 @@ async def process_captcha_if_needed(page: Page) -> bool:
         except Exception:
             pass
 
-        # --- img/canvas/div с 'captcha' / 'capcha' в src/alt/class/id ---
-        try:
-            loc = page.locator(
-                "img[src*='captcha'], img[src*='capcha'], "
-                "img[alt*='captcha'], img[alt*='capcha'], "
-                "canvas[id*='captcha'], canvas[class*='captcha'], "
-                "div[id*='captcha'], div[class*='captcha']"
-            )
-            if await loc.count() > 0:
-                return True
-        except Exception:
-            pass
-
-        # --- input'ы с именем captcha ---
+        # все селекторы + тексты (включая модалки) — один round-trip
         try:
-            loc2 = page.locator(
-                "input[name*='captcha'], input[id*='captcha'], input[aria-label*='captcha']"
-            )
-            if await loc2.count() > 0:
-                return True
+            return bool(await page.evaluate(_HAS_CAPTCHA_JS, _CAPTCHA_TEXT_PATTERN))
         except Exception:
-            pass
-
-        # --- тексты вокруг капчи / проверки безопасности ---
-        texts = [
-            "капча",
-            "Капча",
-            "код с картинки",
-            "введите код",
-            "Введите код",
-            "я не робот",
-            "не робот",
-            "подтвердите, что вы человек",
-            "проверка безопасности",
-            "Проверка безопасности",
-        ]
-        for t in texts:
-            try:
-                if await page.get_by_text(t, exact=True).count() > 0:
-                    return True
-            except Exception:
-                continue
-
-        # --- модальное окно, где может сидеть капча ---
+            return False
+
+    # До 10 сек ждём появления любых признаков капчи. Вместо опроса
+    # по секундному тику: мгновенная проверка, затем wait_for_selector
+    # на объединённом селекторе — он просыпается ровно в момент
+    # появления индикатора, а не на границе тика. Текстовые признаки
+    # без DOM-узлов ловим финальной проверкой после таймаута.
+    has_captcha = await _has_captcha()
+    if not has_captcha:
         try:
-            modal = page.locator(
-                "div[role='dialog'], div[aria-modal='true'], "
-                "div[class*='modal'], div[class*='popup'], div[class*='dialog']"
+            await page.wait_for_selector(
+                _SEL_CAPTCHA_ANY, timeout=10_000, state="attached"
             )
-            if await modal.count() > 0:
-                for t in texts:
-                    if await modal.get_by_text(t, exact=True).count() > 0:
-                        return True
-        except Exception:
-            pass
-
-        return True
-
-    has_captcha = True
-
-    # До 10 сек ждём появления любых признаков капчи
-    for i in range(10):
-        if await _has_captcha():
             has_captcha = True
-            break
-        await page.wait_for_timeout(1000)
+        except Exception:
+            has_captcha = await _has_captcha()
 
     if not has_captcha:
         print("[CAPTCHA_MANAGER] Капча не обнаружена после 10 секунд ожидания — продолжаем поток")
@@ -181,7 +227,7 @@ async def process_captcha_if_needed(page: Page) -> bool:
             for fr in page.frames:
                 url = (fr.url or "").lower()
                 if "recaptcha" in url:
-                    box = fr.locator("span[role='checkbox'], div[role='checkbox']")
+                    box = fr.locator(_SEL_RECAPTCHA_BOX)
                     if await box.count() > 0:
                         await box.first.scroll_into_view_if_needed()
                         await box.first.click()
@@ -194,10 +240,7 @@ async def process_captcha_if_needed(page: Page) -> bool:
         # 2) fallback — чекбокс в модалке или первый чекбокс на странице
         if not clicked:
             try:
-                modal_scope = page.locator(
-                    "div[role='dialog'], div[aria-modal='true'], "
-                    "div[class*='modal'], div[class*='popup'], div[class*='dialog']"
-                )
+                modal_scope = page.locator(_SEL_MODAL)
                 cb = None
 
                 if await modal_scope.count() > 0:
@@ -2,11 +2,15 @@ from __future__ import annotations
 
 import base64
 import os
+import random
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from enum import Enum
 from typing import Optional, Union, List
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import cv2
 import numpy as np
 
@@ -28,6 +32,31 @@ CAPSOLVER_KEY = os.getenv("CAPSOLVER_KEY", "")
 TWOCAPTCHA_KEY = os.getenv("TWOCAPTCHA_KEY", "")
 
 
+# Общая HTTP-сессия с keep-alive: поллинг одного провайдера — это
+# до 20 запросов к одному хосту, без сессии каждый платит новый
+# TCP+TLS хендшейк. Ретраи — на сетевые ошибки, не на бизнес-статусы.
+_HTTP = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3),
+)
+_HTTP.mount("http://", _HTTP_ADAPTER)
+_HTTP.mount("https://", _HTTP_ADAPTER)
+
+
+# Разгон поллинга результата: типичный ответ сервиса приходит за ~6с,
+# фиксированный шаг в 5с округляет время ожидания вверх. Короткие
+# первые интервалы снимают результат почти в момент готовности,
+# дальше выходим на прежний шаг (cap). Джиттер рассинхронизирует
+# параллельные опросы.
+_POLL_RAMP = (0.5, 1.0, 1.5, 2.0, 3.0)
+
+
+def _poll_sleep(delay: float) -> None:
+    time.sleep(delay + random.uniform(0, 0.25))
+
+
 class CaptchaType(str, Enum):
     AUTO = "auto"
     IMAGE = "image"      # обычная картинка с текстом
@@ -38,6 +67,15 @@ class CaptchaType(str, Enum):
 # 🔨 Основной метод
 # =========================
 
+def _decode_gray(image_bytes: bytes) -> Optional[np.ndarray]:
+    """
+    Один grayscale-декод на весь пайплайн: и детектор типа, и локальные
+    решатели работают с одной и той же матрицей вместо повторных
+    cv2.imdecode одних и тех же байтов.
+    """
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+
 def solve_captcha(
     image_bytes: bytes,
     captcha_type: Union[CaptchaType, str] = CaptchaType.AUTO,
@@ -64,11 +102,15 @@ def solve_captcha(
 
     print(f"[CAPTCHA] Начало распознавания… Тип: {captcha_type.value}")
 
+    # image_bytes дальше нужны только для API-провайдеров;
+    # всё локальное работает с одним декодом
+    img = _decode_gray(image_bytes)
+
     # --------------------------------------------------------
     # 1) AUTO → пытаемся определить, слайдер или обычная
     # --------------------------------------------------------
     if captcha_type == CaptchaType.AUTO:
-        if _is_slider(image_bytes):
+        if _is_slider(image_bytes, img=img):
             captcha_type = CaptchaType.SLIDER
         else:
             captcha_type = CaptchaType.IMAGE
@@ -78,13 +120,13 @@ def solve_captcha(
     # 2) SLIDER-капча
     # --------------------------------------------------------
     if captcha_type == CaptchaType.SLIDER:
-        return _solve_slider_chain(image_bytes)
+        return _solve_slider_chain(image_bytes, img=img)
 
     # --------------------------------------------------------
     # 3) Обычная IMAGE-капча (буквы/цифры)
     # --------------------------------------------------------
     if captcha_type == CaptchaType.IMAGE:
-        return _solve_image_chain(image_bytes)
+        return _solve_image_chain(image_bytes, img=img)
 
     print("[CAPTCHA] ❌ Тип капчи не поддержан")
     return None
@@ -94,56 +136,91 @@ def solve_captcha(
 # 🔁 Цепочка решения IMAGE-капчи
 # =========================
 
-def _solve_image_chain(image_bytes: bytes) -> Optional[str]:
+def _solve_image_chain(
+    image_bytes: bytes,
+    img: Optional[np.ndarray] = None,
+) -> Optional[str]:
     """
-    Последовательность попыток для обычной картинной капчи:
+    Попытки для обычной картинной капчи:
 
       1) Локальный OpenCV + pytesseract
-      2) RuCaptcha
-      3) 2Captcha
-      4) Capsolver
+      2) RuCaptcha / 2Captcha / Capsolver — ПАРАЛЛЕЛЬНО,
+         побеждает первый ненулевой ответ.
+
+    Раньше провайдеры опрашивались строго по очереди: worst-case
+    суммировал до 20×5с поллинга на каждого. Параллельный запуск
+    прячет латентность медленных сервисов за самым быстрым.
     """
     print("[CAPTCHA][IMAGE] Пытаемся решить локально (OpenCV + pytesseract)")
-    text = _solve_image_local(image_bytes)
+    text = _solve_image_local(image_bytes, img=img)
     if text:
         print(f"[CAPTCHA][IMAGE] Локально распознано: {text}")
         return text
 
-    # --- RuCaptcha ---
+    providers = []
     if RUCAPTCHA_KEY:
-        print("[CAPTCHA][IMAGE] Переходим к RuCaptcha API")
-        text = _solve_image_rucaptcha(image_bytes)
-        if text:
-            print(f"[CAPTCHA][IMAGE] RuCaptcha решило: {text}")
-            return text
+        providers.append(("rucaptcha", _solve_image_rucaptcha))
     else:
         print("[CAPTCHA][IMAGE] RUCAPTCHA_KEY не задан, пропускаем RuCaptcha")
-
-    # --- 2Captcha ---
     if TWOCAPTCHA_KEY:
-        print("[CAPTCHA][IMAGE] Переходим к 2Captcha API")
-        text = _solve_image_2captcha(image_bytes)
-        if text:
-            print(f"[CAPTCHA][IMAGE] 2Captcha решило: {text}")
-            return text
+        providers.append(("2captcha", _solve_image_2captcha))
     else:
         print("[CAPTCHA][IMAGE] TWOCAPTCHA_KEY не задан, пропускаем 2Captcha")
-
-    # --- Capsolver ---
     if CAPSOLVER_KEY:
-        print("[CAPTCHA][IMAGE] Переходим к Capsolver API")
-        text = _solve_image_capsolver(image_bytes)
-        if text:
-            print(f"[CAPTCHA][IMAGE] Capsolver решило: {text}")
-            return text
+        providers.append(("capsolver", _solve_image_capsolver))
     else:
         print("[CAPTCHA][IMAGE] CAPSOLVER_KEY не задан, пропускаем Capsolver")
 
+    if not providers:
+        print("[CAPTCHA][IMAGE] ❌ Все методы провалились")
+        return None
+
+    # base64 считаем один раз на все провайдеры (memoryview — без
+    # промежуточной копии байтов)
+    b64 = base64.b64encode(memoryview(image_bytes)).decode("ascii")
+
+    if len(providers) == 1:
+        name, fn = providers[0]
+        print(f"[CAPTCHA][IMAGE] Переходим к {name} API")
+        text = fn(b64)
+        if text:
+            print(f"[CAPTCHA][IMAGE] {name} решило: {text}")
+            return text
+        print("[CAPTCHA][IMAGE] ❌ Все методы провалились")
+        return None
+
+    print(f"[CAPTCHA][IMAGE] Запускаем {len(providers)} провайдеров параллельно")
+    pool = ThreadPoolExecutor(
+        max_workers=len(providers), thread_name_prefix="captcha-provider"
+    )
+    futures = {pool.submit(fn, b64): name for name, fn in providers}
+    try:
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                name = futures[fut]
+                try:
+                    text = fut.result()
+                except Exception as e:
+                    print(f"[CAPTCHA][{name}] Ошибка: {e}")
+                    continue
+                if text:
+                    print(f"[CAPTCHA][IMAGE] {name} решило первым: {text}")
+                    return text
+                print(f"[CAPTCHA][{name}] пусто, ждём остальных")
+    finally:
+        # не ждём проигравших: их поллинг дотикает в фоне
+        pool.shutdown(wait=False, cancel_futures=True)
+
     print("[CAPTCHA][IMAGE] ❌ Все методы провалились")
     return None
 
 
-def _solve_image_local(image_bytes: bytes) -> Optional[str]:
+def _solve_image_local(
+    image_bytes: bytes,
+    img: Optional[np.ndarray] = None,
+) -> Optional[str]:
     """
     Локальное распознавание картинной капчи (text) через OpenCV + pytesseract.
 
@@ -156,7 +233,8 @@ def _solve_image_local(image_bytes: bytes) -> Optional[str]:
         return None
 
     try:
-        img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            img = _decode_gray(image_bytes)
         if img is None:
             print("[CAPTCHA][local] Не удалось декодировать изображение")
             return None
@@ -164,7 +242,24 @@ def _solve_image_local(image_bytes: bytes) -> Optional[str]:
         # Бинаризация / повышение контраста
         _, th = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
-        text = pytesseract.image_to_string(th, config="--psm 7")
+        # Tesseract масштабируется по числу пикселей: обрезаем фон
+        # до bounding box символов и апскейлим мелкие картинки
+        nz = cv2.findNonZero(255 - th)
+        if nz is not None:
+            x, y, w, h = cv2.boundingRect(nz)
+            th = th[y:y + h, x:x + w]
+        if th.shape[0] and th.shape[0] < 40:
+            th = cv2.resize(th, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+
+        # whitelist сужает классификатор до типичного капча-алфавита
+        text = pytesseract.image_to_string(
+            th,
+            config=(
+                "--oem 1 --psm 7 "
+                "-c tessedit_char_whitelist=ABCDEFGHJKLMNPQRSTUVWXYZ"
+                "abcdefghjkmnpqrstuvwxyz23456789"
+            ),
+        )
         text = text.strip().replace(" ", "")
 
         # Минимальная длина результата
@@ -179,14 +274,13 @@ def _solve_image_local(image_bytes: bytes) -> Optional[str]:
     return None
 
 
-def _solve_image_rucaptcha(image_bytes: bytes) -> Optional[str]:
+def _solve_image_rucaptcha(b64: str) -> Optional[str]:
     """
     RuCaptcha / rucaptcha.com — классический API (очень похож на 2Captcha).
+    Принимает уже закодированный base64 (кодируется один раз в цепочке).
     """
     try:
-        b64 = base64.b64encode(image_bytes).decode("utf-8")
-
-        create_resp = requests.post(
+        create_resp = _HTTP.post(
             "http://rucaptcha.com/in.php",
             data={
                 "key": RUCAPTCHA_KEY,
@@ -203,9 +297,10 @@ def _solve_image_rucaptcha(image_bytes: bytes) -> Optional[str]:
 
         captcha_id = create_resp["request"]
 
-        # Ожидаем результат
-        for _ in range(20):
-            res = requests.get(
+        # Ожидаем результат (разгон + джиттер, выход на шаг 5с)
+        for delay in _POLL_RAMP + (5.0,) * 17:
+            _poll_sleep(delay)
+            res = _HTTP.get(
                 "http://rucaptcha.com/res.php",
                 params={
                     "key": RUCAPTCHA_KEY,
@@ -220,7 +315,6 @@ def _solve_image_rucaptcha(image_bytes: bytes) -> Optional[str]:
                 return res.get("request")
 
             if res.get("request") in ("CAPCHA_NOT_READY", "CAPTCHA_NOT_READY"):
-                time.sleep(5)
                 continue
 
             print("[CAPTCHA][rucaptcha] error:", res)
@@ -232,14 +326,13 @@ def _solve_image_rucaptcha(image_bytes: bytes) -> Optional[str]:
     return None
 
 
-def _solve_image_2captcha(image_bytes: bytes) -> Optional[str]:
+def _solve_image_2captcha(b64: str) -> Optional[str]:
     """
     2Captcha — аналог RuCaptcha, но свой ключ и домен.
+    Принимает уже закодированный base64.
     """
     try:
-        b64 = base64.b64encode(image_bytes).decode("utf-8")
-
-        create_resp = requests.post(
+        create_resp = _HTTP.post(
             "http://2captcha.com/in.php",
             data={
                 "key": TWOCAPTCHA_KEY,
@@ -256,8 +349,9 @@ def _solve_image_2captcha(image_bytes: bytes) -> Optional[str]:
 
         captcha_id = create_resp["request"]
 
-        for _ in range(20):
-            res = requests.get(
+        for delay in _POLL_RAMP + (5.0,) * 17:
+            _poll_sleep(delay)
+            res = _HTTP.get(
                 "http://2captcha.com/res.php",
                 params={
                     "key": TWOCAPTCHA_KEY,
@@ -272,7 +366,6 @@ def _solve_image_2captcha(image_bytes: bytes) -> Optional[str]:
                 return res.get("request")
 
             if res.get("request") in ("CAPCHA_NOT_READY", "CAPTCHA_NOT_READY"):
-                time.sleep(5)
                 continue
 
             print("[CAPTCHA][2captcha] error:", res)
@@ -284,13 +377,12 @@ def _solve_image_2captcha(image_bytes: bytes) -> Optional[str]:
     return None
 
 
-def _solve_image_capsolver(image_bytes: bytes) -> Optional[str]:
+def _solve_image_capsolver(b64: str) -> Optional[str]:
     """
     Capsolver — AI-сервис, умеющий и текстовые капчи.
+    Принимает уже закодированный base64.
     """
     try:
-        b64 = base64.b64encode(image_bytes).decode("utf-8")
-
         payload = {
             "clientKey": CAPSOLVER_KEY,
             "task": {
@@ -299,7 +391,7 @@ def _solve_image_capsolver(image_bytes: bytes) -> Optional[str]:
             },
         }
 
-        create_resp = requests.post(
+        create_resp = _HTTP.post(
             "https://api.capsolver.com/createTask",
             json=payload,
             timeout=30,
@@ -310,8 +402,9 @@ def _solve_image_capsolver(image_bytes: bytes) -> Optional[str]:
             print("[CAPTCHA][capsolver] create error:", create_resp)
             return None
 
-        for _ in range(20):
-            res = requests.post(
+        for delay in _POLL_RAMP + (3.0,) * 17:
+            _poll_sleep(delay)
+            res = _HTTP.post(
                 "https://api.capsolver.com/getTaskResult",
                 json={"clientKey": CAPSOLVER_KEY, "taskId": task_id},
                 timeout=30,
@@ -321,8 +414,6 @@ def _solve_image_capsolver(image_bytes: bytes) -> Optional[str]:
                 solution = res.get("solution", {})
                 return solution.get("text")
 
-            time.sleep(3)
-
     except Exception as e:
         print(f"[CAPTCHA][capsolver] Ошибка: {e}")
 
@@ -333,7 +424,10 @@ def _solve_image_capsolver(image_bytes: bytes) -> Optional[str]:
 # 🔁 Цепочка решения SLIDER-капчи
 # =========================
 
-def _solve_slider_chain(image_bytes: bytes) -> Optional[int]:
+def _solve_slider_chain(
+    image_bytes: bytes,
+    img: Optional[np.ndarray] = None,
+) -> Optional[int]:
     """
     Цепочка для слайдер-капчи:
 
@@ -341,14 +435,16 @@ def _solve_slider_chain(image_bytes: bytes) -> Optional[int]:
       2) Capsolver (если есть ключ)
     """
     print("[CAPTCHA][SLIDER] Пытаемся решить локально")
-    shift = _solve_slider_local(image_bytes)
+    shift = _solve_slider_local(image_bytes, img=img)
     if shift is not None:
         print(f"[CAPTCHA][SLIDER] Локально найден shift={shift}")
         return shift
 
     if CAPSOLVER_KEY:
         print("[CAPTCHA][SLIDER] Переходим к Capsolver (координаты)")
-        shift = _solve_slider_capsolver(image_bytes)
+        shift = _solve_slider_capsolver(
+            base64.b64encode(memoryview(image_bytes)).decode("ascii")
+        )
         if shift is not None:
             print(f"[CAPTCHA][SLIDER] Capsolver вернул shift={shift}")
             return shift
@@ -359,7 +455,10 @@ def _solve_slider_chain(image_bytes: bytes) -> Optional[int]:
     return None
 
 
-def _solve_slider_local(image_bytes: bytes) -> Optional[int]:
+def _solve_slider_local(
+    image_bytes: bytes,
+    img: Optional[np.ndarray] = None,
+) -> Optional[int]:
     """
     Простейший локальный метод для слайдер-капчи:
       • ищем самый крупный контур (как вырез пазла)
@@ -368,12 +467,23 @@ def _solve_slider_local(image_bytes: bytes) -> Optional[int]:
     Это эвристика, может не работать на всех сайтах.
     """
     try:
-        img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            img = _decode_gray(image_bytes)
         if img is None:
             print("[CAPTCHA][slider_local] Не удалось декодировать изображение")
             return None
 
-        edges = cv2.Canny(img, 50, 200)
+        # Canny — O(pixels): крупные картинки ужимаем до max-стороны 400,
+        # ищем контуры в уменьшенных координатах и масштабируем X обратно
+        ih, iw = img.shape[:2]
+        scale = 400.0 / max(ih, iw) if max(ih, iw) > 400 else 1.0
+        small = (
+            cv2.resize(img, (int(iw * scale), int(ih * scale)), interpolation=cv2.INTER_AREA)
+            if scale < 1.0
+            else img
+        )
+
+        edges = cv2.Canny(small, 50, 200)
         cnts, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
         if not cnts:
@@ -382,11 +492,12 @@ def _solve_slider_local(image_bytes: bytes) -> Optional[int]:
 
         cnts = sorted(cnts, key=cv2.contourArea, reverse=True)
 
+        min_side = 20 * scale
         for c in cnts:
             x, y, w, h = cv2.boundingRect(c)
-            # простая эвристика под пазл
-            if 20 < w < img.shape[1] * 0.8 and 20 < h < img.shape[0] * 0.8:
-                return x
+            # простая эвристика под пазл (в уменьшенных координатах)
+            if min_side < w < small.shape[1] * 0.8 and min_side < h < small.shape[0] * 0.8:
+                return int(x / scale)
 
         return None
 
@@ -395,14 +506,13 @@ def _solve_slider_local(image_bytes: bytes) -> Optional[int]:
         return None
 
 
-def _solve_slider_capsolver(image_bytes: bytes) -> Optional[int]:
+def _solve_slider_capsolver(b64: str) -> Optional[int]:
     """
     Capsolver для слайдер-капчи (ImageToCoordinatesTask).
     Возвращаем X-координату первой найденной точки.
+    Принимает уже закодированный base64.
     """
     try:
-        b64 = base64.b64encode(image_bytes).decode("utf-8")
-
         create_payload = {
             "clientKey": CAPSOLVER_KEY,
             "task": {
@@ -411,7 +521,7 @@ def _solve_slider_capsolver(image_bytes: bytes) -> Optional[int]:
             },
         }
 
-        create_resp = requests.post(
+        create_resp = _HTTP.post(
             "https://api.capsolver.com/createTask",
             json=create_payload,
             timeout=30,
@@ -422,8 +532,9 @@ def _solve_slider_capsolver(image_bytes: bytes) -> Optional[int]:
             print("[CAPTCHA][capsolver_slider] create error:", create_resp)
             return None
 
-        for _ in range(20):
-            res = requests.post(
+        for delay in _POLL_RAMP + (2.0,) * 17:
+            _poll_sleep(delay)
+            res = _HTTP.post(
                 "https://api.capsolver.com/getTaskResult",
                 json={"clientKey": CAPSOLVER_KEY, "taskId": task_id},
                 timeout=30,
@@ -435,8 +546,6 @@ def _solve_slider_capsolver(image_bytes: bytes) -> Optional[int]:
                     return int(coords[0].get("x", 0))
                 return None
 
-            time.sleep(2)
-
     except Exception as e:
         print(f"[CAPTCHA][capsolver_slider] Ошибка: {e}")
 
@@ -447,24 +556,30 @@ def _solve_slider_capsolver(image_bytes: bytes) -> Optional[int]:
 # 🔍 Определение типа (slider / image)
 # =========================
 
-def _is_slider(image_bytes: bytes) -> bool:
+def _is_slider(image_bytes: bytes, img: Optional[np.ndarray] = None) -> bool:
     """
     Примитивный детектор slider-капчи по геометрии/яркости.
     Это эвристика, не строгая, но для AUTO-режима достаточно.
     """
     try:
-        img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        # grayscale: для геометрии и яркости цвет не нужен, а декод
+        # и mean по одному каналу втрое дешевле по памяти
+        if img is None:
+            img = _decode_gray(image_bytes)
         if img is None:
             return False
 
         h, w = img.shape[:2]
 
-        # slider часто широкий и невысокий
+        # slider часто широкий и невысокий (ранний выход без mean)
         if w > 250 and h < 150:
             return True
 
-        # Простой анализ средней яркости – slider часто светло-серый
-        avg_color = img.mean()
+        # Простой анализ средней яркости – slider часто светло-серый.
+        # Считаем по уменьшенной копии: INTER_AREA усредняет блоки,
+        # так что среднее почти не меняется, а пикселей в ~сотни раз меньше.
+        small = cv2.resize(img, (64, 32), interpolation=cv2.INTER_AREA)
+        avg_color = small.mean()
         if 120 < avg_color < 210:
             return True
 
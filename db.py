@@ -1,18 +1,40 @@
 from __future__ import annotations
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 # ВАЖНО: без точки, т.к. мы не внутри пакета
 from agent_config import DB_URL
 
 
-# Создаём движок БД
-engine = create_engine(
-    DB_URL,
-    echo=False,
-    future=True,
-)
+# Создаём движок БД.
+# Для SQLite пул не настраиваем (файл локальный, один процесс),
+# для Postgres/MySQL — включаем QueuePool с запасом под параллельные
+# запросы админки и воркеров.
+if DB_URL.startswith("sqlite"):
+    engine = create_engine(
+        DB_URL,
+        echo=False,
+        future=True,
+        # кэш скомпилированных стейтментов: наши запросы мелкие и
+        # повторяются очень часто (дашборд, поллинг очереди)
+        query_cache_size=1200,
+        connect_args={"check_same_thread": False},
+    )
+else:
+    engine = create_engine(
+        DB_URL,
+        echo=False,
+        future=True,
+        query_cache_size=1200,
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=3600,
+        # не висеть на checkout'е бесконечно, если пул исчерпан
+        pool_timeout=10,
+    )
 
 # Сессии для работы с БД
 SessionLocal = sessionmaker(
@@ -22,5 +44,107 @@ SessionLocal = sessionmaker(
     future=True,
 )
 
+# -------------------------------------------------------------
+# ASYNC-ДВИЖОК (для FastAPI-админки)
+# -------------------------------------------------------------
+# Синхронные хендлеры FastAPI крутятся в тредпуле и упираются в его
+# лимит под нагрузкой; админка работает через async-сессии.
+# Движок создаётся лениво: агенту/воркерам/CLI нужен только sync-движок,
+# и импорт db.py не должен требовать aiosqlite/asyncpg.
+# sqlite → aiosqlite, postgresql → asyncpg, mysql → aiomysql.
+_ASYNC_DRIVERS = {
+    "sqlite://": "sqlite+aiosqlite://",
+    "postgresql://": "postgresql+asyncpg://",
+    "mysql://": "mysql+aiomysql://",
+}
+
+_async_engine = None
+_async_sessionmaker = None
+
+
+def get_async_engine():
+    global _async_engine
+    if _async_engine is None:
+        for prefix, async_prefix in _ASYNC_DRIVERS.items():
+            if DB_URL.startswith(prefix):
+                async_url = DB_URL.replace(prefix, async_prefix, 1)
+                break
+        else:
+            raise RuntimeError(
+                f"Async-драйвер для DB_URL={DB_URL!r} не настроен "
+                f"(поддерживаются: {', '.join(_ASYNC_DRIVERS)})"
+            )
+        if DB_URL.startswith("sqlite"):
+            _async_engine = create_async_engine(
+                async_url,
+                echo=False,
+                query_cache_size=1200,
+            )
+            event.listens_for(_async_engine.sync_engine, "connect")(
+                _sqlite_on_connect
+            )
+        else:
+            _async_engine = create_async_engine(
+                async_url,
+                echo=False,
+                query_cache_size=1200,
+                pool_size=20,
+                max_overflow=10,
+                pool_pre_ping=True,
+                pool_recycle=3600,
+                # не висеть на checkout'е бесконечно, если пул исчерпан
+                pool_timeout=10,
+            )
+    return _async_engine
+
+
+def get_async_sessionmaker():
+    global _async_sessionmaker
+    if _async_sessionmaker is None:
+        _async_sessionmaker = async_sessionmaker(
+            get_async_engine(),
+            autoflush=False,
+            expire_on_commit=False,
+        )
+    return _async_sessionmaker
+
+
+def insert_for_dialect():
+    """
+    INSERT с поддержкой ON CONFLICT под текущий диалект. Только
+    postgresql/sqlite умеют этот синтаксис — на других диалектах
+    падаем с понятной ошибкой вместо кривого SQL.
+    """
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif engine.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise RuntimeError(
+            f"ON CONFLICT не поддержан для диалекта {engine.dialect.name!r}"
+        )
+    return insert
+
+
+# -------------------------------------------------------------
+# SQLITE PRAGMA-ТЮНИНГ
+# -------------------------------------------------------------
+# WAL: читатели не блокируются писателем; synchronous=NORMAL режет
+# стоимость fsync на commit (дефолтный FULL синкает каждый раз);
+# busy_timeout спасает от "database is locked" при параллельных
+# воркерах/админке.
+def _sqlite_on_connect(dbapi_conn, _connection_record) -> None:
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
+if DB_URL.startswith("sqlite"):
+    event.listens_for(engine, "connect")(_sqlite_on_connect)
+
 # Базовый класс моделей
 Base = declarative_base()
\ No newline at end of file
@@ -2,8 +2,15 @@ from __future__ import annotations
 
 import os
 import json
+import time
 import asyncio
-from datetime import datetime
+
+# orjson — сериализатор на C, в 3-10 раз быстрее stdlib json и отдаёт
+# сразу bytes; при его отсутствии тихо откатываемся на stdlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from playwright.async_api import async_playwright, Page, BrowserContext
 
@@ -22,7 +29,15 @@ def _ensure_log_dir() -> None:
 
 
 def _ts() -> str:
-    return datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f")
+    # Горячий путь: зовётся на каждый ответ сети и строку консоли.
+    # Ручная сборка через f-string в разы дешевле интерпретатора
+    # формата strftime (и без deprecated utcnow()).
+    s, us = divmod(time.time_ns() // 1000, 1_000_000)
+    tm = time.gmtime(s)
+    return (
+        f"{tm.tm_year:04d}{tm.tm_mon:02d}{tm.tm_mday:02d}"
+        f"_{tm.tm_hour:02d}{tm.tm_min:02d}{tm.tm_sec:02d}_{us:06d}"
+    )
 
 
 # ------------------------------------------------------------
@@ -32,8 +47,13 @@ def _ts() -> str:
 def attach_console_logger(page: Page, session_id: str) -> None:
     """
     Логируем все сообщения консоли в один файл.
+
+    Хэндл открывается один раз с большим буфером: раньше каждое
+    сообщение платило open/write/close — три syscall'а на строку,
+    на шумной странице это основная цена колбэка.
     """
     console_log_path = os.path.join(LOG_DIR, f"console_{session_id}.log")
+    f = open(console_log_path, "a", encoding="utf-8", buffering=1 << 16)
 
     def _on_console(msg):
         try:
@@ -45,31 +65,136 @@ def attach_console_logger(page: Page, session_id: str) -> None:
         print("[CONSOLE]", line.strip())
 
         try:
-            with open(console_log_path, "a", encoding="utf-8") as f:
-                f.write(line)
+            f.write(line)
         except Exception as e:
             print(f"[RECORDER] Ошибка записи console log: {e}")
 
+    def _on_close(_):
+        try:
+            f.close()
+        except Exception:
+            pass
+
     page.on("console", _on_console)
+    page.on("close", _on_close)
 
 
 # ------------------------------------------------------------
 # ЛОГИРОВАНИЕ СЕТИ (api.multitransfer.ru)
 # ------------------------------------------------------------
 
+# Размер очереди ответов: под всплеск трафика от api.multitransfer.ru.
+# Если писатель не успевает — новые ответы дропаются (лог важнее,
+# чем неограниченный рост памяти).
+NET_QUEUE_SIZE = 256
+
+# Сколько накопившихся ответов писатель забирает за одно пробуждение:
+# при всплеске пачка уходит на диск одним заходом в тредпул вместо
+# цикла «проснулся — записал одну строку — уснул»
+NET_BATCH_SIZE = 64
+
+# После стольких строк открываем новый шард responses_*.jsonl
+MAX_LINES_PER_SHARD = 10000
+
+# Тела крупнее этого в лог не читаем (по content-length)
+MAX_BODY_BYTES = 256 * 1024
+
+# ------------------------------------------------------------
+# СИНХРОННЫЕ ПИСАТЕЛИ (зовутся через asyncio.to_thread: мегабайтный
+# HTML/PNG, записанный прямо на event loop, стопорит CDP-диспетчер
+# Playwright на десятки миллисекунд)
+# ------------------------------------------------------------
+
+def _dumps_pretty(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def _dumps_line(data) -> str:
+    """Одна JSONL-строка (с \\n на конце)."""
+    if orjson is not None:
+        return orjson.dumps(data).decode("utf-8") + "\n"
+    return json.dumps(data, ensure_ascii=False) + "\n"
+
+
+def _write_json_file(path: str, data) -> None:
+    with open(path, "wb") as f:
+        f.write(_dumps_pretty(data))
+
+
+def _write_text_file(path: str, text: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def _write_bytes_file(path: str, data: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+# Логируем только API-трафик — фильтр применяется синхронно в самом
+# колбэке, до очереди: статика/бандлы не стоят ни постановки в
+# очередь, ни пробуждения писателя
+API_HOST = "api.multitransfer.ru"
+
+# Полные заголовки каждого ответа — только по явному запросу
+LOG_FULL_HEADERS = os.getenv("MT_LOG_HEADERS", "0") == "1"
+
+# Тяжёлые ресурсы сторонних хостов (трекинг-пиксели, аналитика,
+# шрифтовые CDN) режем ещё на уровне браузера — меньше событий
+# response и трафика. Ресурсы самого multitransfer.ru не трогаем:
+# сессию ведёт живой человек, ему нужна рабочая страница с картинками.
+_BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+
+
+async def _route_filter(route, request) -> None:
+    if (
+        request.resource_type in _BLOCKED_RESOURCE_TYPES
+        and "multitransfer.ru" not in request.url
+    ):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
 def attach_network_logger(page: Page, session_id: str) -> None:
     """
     Логируем все ответы от api.multitransfer.ru.
-    Каждый ответ — отдельный JSON-файл.
+    Ответы пишутся строками JSONL в responses_{session}_{NNN}.jsonl
+    (шард закрывается после MAX_LINES_PER_SHARD строк): раньше на
+    каждый ответ создавался отдельный файл — сотни inode и цикл
+    open/close на запись, теперь это один append в открытый хэндл.
+
+    Ответы складываются в ограниченную очередь, которую разгребает
+    ОДИН фоновый писатель: раньше на каждый ответ создавался свой
+    asyncio.Task, а json.dump/open блокировали event loop Playwright.
+    Теперь память ограничена размером очереди, а запись на диск
+    уходит в тредпул через asyncio.to_thread.
     """
-    async def _handle_response(response):
-        url = response.url
-        if "api.multitransfer.ru" not in url:
-            return
+    queue: asyncio.Queue = asyncio.Queue(maxsize=NET_QUEUE_SIZE)
+
+    # Состояние шарда живёт в замыкании; трогает его только писатель,
+    # поэтому блокировки не нужны
+    shard = {"fh": None, "lines": 0, "idx": 0}
+
+    def _ensure_shard() -> None:
+        if shard["fh"] is None or shard["lines"] >= MAX_LINES_PER_SHARD:
+            if shard["fh"] is not None:
+                shard["fh"].close()
+                shard["idx"] += 1
+                shard["lines"] = 0
+            path = os.path.join(
+                LOG_DIR, f"responses_{session_id}_{shard['idx']:03d}.jsonl"
+            )
+            shard["fh"] = open(path, "a", encoding="utf-8")
+            print(f"[NET] Пишу ответы в {path}")
 
+    async def _handle_response(response):
+        # фильтр по URL уже отработал в _on_response
         entry = {
             "timestamp": _ts(),
-            "url": url,
+            "url": response.url,
         }
 
         try:
@@ -77,17 +202,33 @@ def attach_network_logger(page: Page, session_id: str) -> None:
         except Exception:
             entry["status"] = None
 
-        try:
-            headers = await response.all_headers()
-        except Exception:
-            headers = {}
-        entry["headers"] = headers
+        # Полный словарь заголовков тащим через CDP только по явному
+        # запросу — обычно хватает двух точечных header_value
+        if LOG_FULL_HEADERS:
+            try:
+                entry["headers"] = await response.all_headers()
+            except Exception:
+                pass
 
-        # Пытаемся понять, JSON или нет
+        # Пытаемся понять, JSON или нет. Тела больше 256 КБ (бандлы,
+        # картинки) не читаем вовсе; для не-JSON вместо полного
+        # response.text() — len(bytes) и первые 2 КБ с errors="replace":
+        # декодирование O(2KB) вместо O(размер тела).
         body_saved = False
         try:
-            ct = headers.get("content-type", "") or headers.get("Content-Type", "")
-            if "application/json" in ct.lower():
+            # header_value отдаёт один заголовок без регистрозависимой
+            # возни и без полного multi-header словаря
+            ct = (await response.header_value("content-type")) or ""
+            try:
+                clen = int((await response.header_value("content-length")) or 0)
+            except ValueError:
+                clen = 0
+
+            if clen > MAX_BODY_BYTES:
+                entry["body_size"] = clen
+                entry["body_skipped"] = True
+                body_saved = True
+            elif "application/json" in ct.lower():
                 try:
                     data = await response.json()
                     entry["json"] = data
@@ -97,52 +238,119 @@ def attach_network_logger(page: Page, session_id: str) -> None:
 
             if not body_saved:
                 try:
-                    txt = await response.text()
-                    entry["text"] = txt[:5000]  # чтобы не раздувать файл
+                    raw = await response.body()
+                    entry["body_size"] = len(raw)
+                    entry["text"] = raw[:2048].decode("utf-8", "replace")
                 except Exception as e_txt:
                     entry["text_error"] = str(e_txt)
         except Exception as e:
             entry["body_error"] = str(e)
 
-        # Пишем в файл
-        fname = os.path.join(
-            LOG_DIR,
-            f"response_{session_id}_{_ts()}.json",
-        )
-        print(f"[NET] Логирую ответ → {fname}")
+        return _dumps_line(entry)
+
+    def _append_lines(lines) -> None:
+        # Синхронная запись — зовётся из тредпула одним писателем.
+        # Пачку склеиваем и пишем одним write() на шард: join по
+        # готовым строкам дешевле, чем syscall на каждую
+        i = 0
+        while i < len(lines):
+            _ensure_shard()
+            room = MAX_LINES_PER_SHARD - shard["lines"]
+            chunk = lines[i:i + room]
+            shard["fh"].write("".join(chunk))
+            shard["lines"] += len(chunk)
+            i += len(chunk)
+
+    async def _writer():
+        # Единственный потребитель очереди. За одно пробуждение
+        # забираем всё, что успело накопиться (до NET_BATCH_SIZE),
+        # и сбрасываем пачку на диск одним заходом в тредпул.
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < NET_BATCH_SIZE:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            lines = []
+            for response in batch:
+                try:
+                    lines.append(await _handle_response(response))
+                except Exception as e:
+                    print(f"[RECORDER] Ошибка обработки ответа: {e}")
+                finally:
+                    queue.task_done()
+
+            if lines:
+                try:
+                    await asyncio.to_thread(_append_lines, lines)
+                except Exception as e:
+                    print(f"[RECORDER] Ошибка записи response log: {e}")
+
+    def _on_response(response):
+        if API_HOST not in response.url:
+            return
         try:
-            with open(fname, "w", encoding="utf-8") as f:
-                json.dump(entry, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"[RECORDER] Ошибка записи response log: {e}")
+            queue.put_nowait(response)
+        except asyncio.QueueFull:
+            print(f"[RECORDER] Очередь ответов переполнена, дропаю {response.url}")
 
-    # Важно: заворачиваем в create_task, чтобы не блокировать Playwright
-    page.on("response", lambda resp: asyncio.create_task(_handle_response(resp)))
+    # Сильная ссылка на писателя обязательна: asyncio держит Task'и
+    # по слабой ссылке, и без неё сборщик может убить писателя посреди
+    # сессии. Вешаем на page — живёт столько же, сколько логгер.
+    writer_task = asyncio.create_task(_writer())
+    page._mt_net_writer = writer_task
+
+    def _on_close(_):
+        writer_task.cancel()
+        if shard["fh"] is not None:
+            shard["fh"].close()
+            shard["fh"] = None
+
+    page.on("response", _on_response)
+    page.on("close", _on_close)
 
 
 # ------------------------------------------------------------
 # СНИМОК window.* (ключей глобального состояния)
 # ------------------------------------------------------------
 
-async def snapshot_window_state(page: Page, session_id: str, label: str) -> None:
-    """
-    Делаем небольшой снимок JS-окружения:
-      - Object.keys(window)
-      - пытаемся снять ключи популярных глобалов (app, store, __NUXT__ и т.п.)
-    """
-    _ensure_log_dir()
-    out = {
-        "timestamp": _ts(),
-        "label": label,
-        "url": page.url,
-    }
-
-    script = """
+# Тело снимка window.* — собирается один раз при импорте. В main()
+# устанавливается на страницу init-скриптом как window.__snapshotState,
+# чтобы V8 компилировал его один раз, а не на каждый evaluate
+# с ~30-строчным исходником.
+WINDOW_SNAPSHOT_JS = """
     () => {
       const res = {};
       try {
-        const keys = Object.keys(window);
-        res.windowKeys = keys;
+        // собственные служебные глобалы рекордера в снимок не включаем
+        const keys = Object.keys(window).filter(
+          (k) => k !== "__lastKeys" && k !== "__snapshotState"
+        );
+
+        // Сотни ключей window почти не меняются между снимками —
+        // полный список шлём только в первый раз, дальше только
+        // added/removed относительно предыдущего снимка (+ хэш
+        // отсортированного списка для сверки на стороне Python)
+        let h = 0;
+        for (const k of [...keys].sort()) {
+          for (let i = 0; i < k.length; i++) {
+            h = ((h << 5) - h + k.charCodeAt(i)) | 0;
+          }
+        }
+        res.keysHash = h;
+        res.keysCount = keys.length;
+
+        const last = window.__lastKeys;
+        if (!last) {
+          res.windowKeys = keys;
+        } else {
+          const cur = new Set(keys);
+          res.keysAdded = keys.filter((k) => !last.has(k));
+          res.keysRemoved = [...last].filter((k) => !cur.has(k));
+        }
+        window.__lastKeys = new Set(keys);
 
         const candidates = [
           'app', 'store', '__NUXT__', '__INITIAL_STATE__',
@@ -179,17 +387,46 @@ async def snapshot_window_state(page: Page, session_id: str, label: str) -> None
       return res;
     }
     """
-    try:
-        data = await page.evaluate(script)
+
+
+async def snapshot_window_state(
+    page: Page, session_id: str, label: str, data=None, ts: str | None = None
+) -> None:
+    """
+    Делаем небольшой снимок JS-окружения:
+      - Object.keys(window)
+      - пытаемся снять ключи популярных глобалов (app, store, __NUXT__ и т.п.)
+
+    data — уже снятый результат из объединённого снимка,
+    ts — общий таймстемп прохода (один на все файлы снимка).
+    """
+    _ensure_log_dir()
+    ts = ts or _ts()
+    out = {
+        "timestamp": ts,
+        "label": label,
+        "url": page.url,
+    }
+
+    if data is not None:
         out["data"] = data
-    except Exception as e:
-        out["evaluate_error"] = str(e)
+    else:
+        try:
+            # Скомпилированная один раз функция из init-скрипта; если её
+            # нет (страница подключена без main()) — шлём исходник как раньше
+            data = await page.evaluate(
+                "() => window.__snapshotState ? window.__snapshotState() : null"
+            )
+            if data is None:
+                data = await page.evaluate(WINDOW_SNAPSHOT_JS)
+            out["data"] = data
+        except Exception as e:
+            out["evaluate_error"] = str(e)
 
-    fname = os.path.join(LOG_DIR, f"window_snapshot_{session_id}_{label}_{_ts()}.json")
+    fname = os.path.join(LOG_DIR, f"window_snapshot_{session_id}_{label}_{ts}.json")
     print(f"[SNAPSHOT] Сохраняю snapshot window → {fname}")
     try:
-        with open(fname, "w", encoding="utf-8") as f:
-            json.dump(out, f, ensure_ascii=False, indent=2)
+        await asyncio.to_thread(_write_json_file, fname, out)
     except Exception as e:
         print(f"[RECORDER] Ошибка записи snapshot: {e}")
 
@@ -198,17 +435,9 @@ async def snapshot_window_state(page: Page, session_id: str, label: str) -> None
 # СНИМОК СОСТОЯНИЯ MULTITRANSFER (stepsData, 'Способ перевода', офферы)
 # ------------------------------------------------------------
 
-async def snapshot_mt_state(page: Page, session_id: str, label: str) -> None:
-    """
-    Читает с клиента:
-      - stepsData из localStorage
-      - amount / currencyAmount / amountOk
-      - наличие кликабельного "Способ перевода"
-      - наличие офферов / 'Выбрать'
-      - текст 'нет доступных способов'
-    """
-    _ensure_log_dir()
-    js = """
+# JS снимка состояния Multitransfer — константа модуля: участвует и в
+# одиночном snapshot_mt_state, и в объединённом снимке COMBINED_SNAPSHOT_JS
+MT_STATE_JS = """
     () => {
       const info = {
         stepsRaw: null,
@@ -255,17 +484,28 @@ async def snapshot_mt_state(page: Page, session_id: str, label: str) -> None:
         // ignore
       }
 
+      // innerText всего body берём один раз и переиспользуем: и как
+      // быстрый префильтр перед обходом всех узлов, и для проверки
+      // «нет доступных способов» в конце
+      const bodyLower = (document.body && document.body.innerText || "").toLowerCase();
+
       // --- 2) ищем 'Способ перевода' / 'Выберите способ...' ---
       try {
-        const allNodes = Array.from(document.querySelectorAll("*"));
-        const labelNodes = allNodes.filter((el) => {
-          const t = (el.textContent || "").toLowerCase();
-          return (
-            t.includes("способ перевода") ||
-            t.includes("способ оплаты") ||
-            t.includes("выберите способ")
-          );
-        });
+        const hasMethodText =
+          bodyLower.indexOf("способ перевода") >= 0 ||
+          bodyLower.indexOf("способ оплаты") >= 0 ||
+          bodyLower.indexOf("выберите способ") >= 0;
+
+        // полный обход узлов — только если текст вообще есть на странице
+        const labelNodes = !hasMethodText ? [] :
+          Array.from(document.querySelectorAll("*")).filter((el) => {
+            const t = (el.textContent || "").toLowerCase();
+            return (
+              t.indexOf("способ перевода") >= 0 ||
+              t.indexOf("способ оплаты") >= 0 ||
+              t.indexOf("выберите способ") >= 0
+            );
+          });
 
         if (labelNodes.length > 0) {
           info.methodLabelFound = true;
@@ -310,7 +550,7 @@ async def snapshot_mt_state(page: Page, session_id: str, label: str) -> None:
         const buttons = Array.from(document.querySelectorAll("button, [role='button']"));
         const offers = buttons.filter((el) => {
           const t = (el.textContent || "").toLowerCase();
-          return t.includes("выбрать");
+          return t.indexOf("выбрать") >= 0;
         });
         info.offersCount = offers.length;
         info.hasOfferButton = offers.length > 0;
@@ -320,11 +560,10 @@ async def snapshot_mt_state(page: Page, session_id: str, label: str) -> None:
 
       // --- 4) текст про отсутствие доступных способов ---
       try {
-        const bodyText = (document.body.innerText || "").toLowerCase();
         if (
-          bodyText.includes("нет доступных способов") ||
-          bodyText.includes("нет доступных офферов") ||
-          bodyText.includes("нет доступных предложений")
+          bodyLower.indexOf("нет доступных способов") >= 0 ||
+          bodyLower.indexOf("нет доступных офферов") >= 0 ||
+          bodyLower.indexOf("нет доступных предложений") >= 0
         ) {
           info.hasNoOffersText = true;
         }
@@ -336,10 +575,27 @@ async def snapshot_mt_state(page: Page, session_id: str, label: str) -> None:
     }
     """
 
-    try:
-        data = await page.evaluate(js)
-    except Exception as e:
-        data = {"evaluate_error": str(e)}
+
+async def snapshot_mt_state(
+    page: Page, session_id: str, label: str, data=None, ts: str | None = None
+) -> None:
+    """
+    Читает с клиента:
+      - stepsData из localStorage
+      - amount / currencyAmount / amountOk
+      - наличие кликабельного "Способ перевода"
+      - наличие офферов / 'Выбрать'
+      - текст 'нет доступных способов'
+
+    data — уже снятый результат MT_STATE_JS (из объединённого снимка);
+    если не передан, делаем свой evaluate.
+    """
+    _ensure_log_dir()
+    if data is None:
+        try:
+            data = await page.evaluate(MT_STATE_JS)
+        except Exception as e:
+            data = {"evaluate_error": str(e)}
 
     # Краткий лог в консоль
     print(
@@ -356,11 +612,10 @@ async def snapshot_mt_state(page: Page, session_id: str, label: str) -> None:
     )
 
     # Полный JSON на диск
-    fname = os.path.join(LOG_DIR, f"mt_state_{session_id}_{label}_{_ts()}.json")
+    fname = os.path.join(LOG_DIR, f"mt_state_{session_id}_{label}_{ts or _ts()}.json")
     print(f"[MT-STATE] Сохраняю состояние Multitransfer → {fname}")
     try:
-        with open(fname, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        await asyncio.to_thread(_write_json_file, fname, data)
     except Exception as e:
         print(f"[RECORDER] Ошибка записи MT state: {e}")
 
@@ -369,38 +624,56 @@ async def snapshot_mt_state(page: Page, session_id: str, label: str) -> None:
 # СНИМОК ДЕРЕВА КЛИКАБЕЛЬНЫХ ЭЛЕМЕНТОВ
 # ------------------------------------------------------------
 
-async def snapshot_clickable_tree(page: Page, session_id: str, label: str) -> None:
-    """
-    Собираем все кликабельные элементы:
-      - button / a
-      - [role="button"]
-      - [onclick]
-      - cursor: pointer
-      - tabIndex >= 0
-
-    С координатами, видимостью, текстом и классами.
-    """
-    _ensure_log_dir()
-
-    js = """
+# JS дерева кликабельных элементов — константа модуля (см. MT_STATE_JS)
+CLICKABLE_TREE_JS = """
     () => {
       const res = [];
-      const all = Array.from(document.querySelectorAll("*"));
 
-      for (const el of all) {
-        try {
-          const style = window.getComputedStyle(el);
-          const rect = el.getBoundingClientRect();
+      // TreeWalker вместо Array.from(querySelectorAll("*")): не
+      // материализуем массив JS-обёрток на каждый DOM-узел, а грубый
+      // фильтр по тегу/атрибутам выполняется ещё при обходе — до
+      // тела цикла доживает малая часть дерева. Элементы, кликабельные
+      // только через вычисленный cursor:pointer (без атрибутов и
+      // inline-стиля), в снимок не попадают — осознанный компромисс.
+      const walker = document.createTreeWalker(
+        document.body || document.documentElement,
+        NodeFilter.SHOW_ELEMENT,
+        {
+          acceptNode(n) {
+            const t = n.tagName;
+            if (t === "BUTTON" || t === "A") return NodeFilter.FILTER_ACCEPT;
+            if (
+              n.hasAttribute("role") ||
+              n.hasAttribute("onclick") ||
+              n.hasAttribute("tabindex") ||
+              (n.style && n.style.cursor === "pointer")
+            ) {
+              return NodeFilter.FILTER_ACCEPT;
+            }
+            return NodeFilter.FILTER_SKIP;
+          },
+        }
+      );
 
-          const clickable =
-            el.tagName === "BUTTON" ||
-            el.tagName === "A" ||
+      let el;
+      while ((el = walker.nextNode())) {
+        try {
+          // Точные проверки — только для прошедших грубый фильтр
+          const tag = el.tagName;
+          let clickable =
+            tag === "BUTTON" ||
+            tag === "A" ||
             el.getAttribute("role") === "button" ||
             el.hasAttribute("onclick") ||
-            style.cursor === "pointer" ||
             el.tabIndex >= 0;
 
-          if (!clickable) continue;
+          let style = null;
+          if (!clickable) {
+            style = window.getComputedStyle(el);
+            if (style.cursor !== "pointer") continue;
+          }
+          if (!style) style = window.getComputedStyle(el);
+          const rect = el.getBoundingClientRect();
 
           const visible =
             rect.width > 0 &&
@@ -414,7 +687,7 @@ async def snapshot_clickable_tree(page: Page, session_id: str, label: str) -> No
             .trim();
 
           res.push({
-            tag: el.tagName,
+            tag: tag,
             id: el.id || null,
             classes: el.className || "",
             role: el.getAttribute("role") || null,
@@ -442,52 +715,142 @@ async def snapshot_clickable_tree(page: Page, session_id: str, label: str) -> No
         } catch (e) {
           // ignore отдельные элементы
         }
+        // Чтобы не улететь в мегабайты — ограничим до 500 элементов
+        if (res.length >= 500) break;
       }
 
-      // Чтобы не улететь в мегабайты — ограничим до 500 элементов
-      return res.slice(0, 500);
+      return res;
     }
     """
 
-    try:
-        data = await page.evaluate(js)
-    except Exception as e:
-        data = {"evaluate_error": str(e)}
 
-    fname = os.path.join(LOG_DIR, f"clickable_{session_id}_{label}_{_ts()}.json")
+async def snapshot_clickable_tree(
+    page: Page, session_id: str, label: str, data=None, ts: str | None = None
+) -> None:
+    """
+    Собираем все кликабельные элементы:
+      - button / a
+      - [role="button"]
+      - [onclick]
+      - cursor: pointer
+      - tabIndex >= 0
+
+    С координатами, видимостью, текстом и классами.
+    data — уже снятый результат CLICKABLE_TREE_JS из объединённого снимка.
+    """
+    _ensure_log_dir()
+    if data is None:
+        try:
+            data = await page.evaluate(CLICKABLE_TREE_JS)
+        except Exception as e:
+            data = {"evaluate_error": str(e)}
+
+    fname = os.path.join(LOG_DIR, f"clickable_{session_id}_{label}_{ts or _ts()}.json")
     print(f"[CLICKABLE] Сохраняю дерево кликабельных элементов → {fname}")
     try:
-        with open(fname, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        await asyncio.to_thread(_write_json_file, fname, data)
     except Exception as e:
         print(f"[RECORDER] Ошибка записи clickable tree: {e}")
 
 
 # ------------------------------------------------------------
-# СНИМОК HTML + СКРИН
+# ОБЪЕДИНЁННЫЙ СНИМОК (window + MT state + clickable за один evaluate)
 # ------------------------------------------------------------
 
-async def snapshot_page_html_and_screenshot(page: Page, session_id: str, label: str) -> None:
-    _ensure_log_dir()
-    ts = _ts()
-
-    # HTML
-    html_path = os.path.join(LOG_DIR, f"page_{session_id}_{label}_{ts}.html")
+# Три отдельных evaluate — три CDP round-trip'а на каждый снимок.
+# Здесь все три функции выполняются в браузере за один вызов.
+COMBINED_SNAPSHOT_JS = (
+    "() => ({\n"
+    "  window: (window.__snapshotState"
+    " ? window.__snapshotState() : (" + WINDOW_SNAPSHOT_JS + ")()),\n"
+    "  mt: (" + MT_STATE_JS + ")(),\n"
+    "  clickable: (" + CLICKABLE_TREE_JS + ")()\n"
+    "})"
+)
+
+
+async def snapshot_combined(
+    page: Page, session_id: str, label: str, ts: str | None = None
+) -> None:
+    """Снимает window/MT state/clickable одним evaluate и раскладывает
+    результат по тем же трём файлам, что и одиночные функции.
+
+    Таймстемп считаем один раз на проход — все три файла получают
+    одинаковый суффикс и легко коррелируются между собой."""
+    ts = ts or _ts()
     try:
-        html = await page.content()
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(html)
-        print(f"[SNAPSHOT] HTML → {html_path}")
+        data = await page.evaluate(COMBINED_SNAPSHOT_JS)
     except Exception as e:
-        print(f"[SNAPSHOT] Ошибка сохранения HTML: {e}")
+        print(f"[SNAPSHOT] Ошибка объединённого снимка: {e}")
+        data = {}
+
+    err = {"evaluate_error": "combined snapshot failed"}
+    await snapshot_window_state(page, session_id, label, data=data.get("window", err), ts=ts)
+    await snapshot_mt_state(page, session_id, label, data=data.get("mt", err), ts=ts)
+    await snapshot_clickable_tree(page, session_id, label, data=data.get("clickable", err), ts=ts)
 
-    # Screenshot
-    png_path = os.path.join(LOG_DIR, f"page_{session_id}_{label}_{ts}.png")
+
+# ------------------------------------------------------------
+# СНИМОК HTML + СКРИН
+# ------------------------------------------------------------
+
+async def _page_html_snapshot(page: Page):
+    """
+    Снимает страницу как MHTML через CDP Page.captureSnapshot:
+    Chromium отдаёт уже сериализованную строку, без пересборки DOM в
+    Python-str через page.content() и двойного копирования документа.
+    CDP-сессию кэшируем на странице. Возвращает (расширение,
+    содержимое); при недоступности CDP откатываемся на page.content().
+    """
     try:
-        await page.screenshot(path=png_path, full_page=True)
-        print(f"[SNAPSHOT] PNG → {png_path}")
-    except Exception as e:
-        print(f"[SNAPSHOT] Ошибка сохранения PNG: {e}")
+        cdp = getattr(page, "_mt_cdp", None)
+        if cdp is None:
+            cdp = await page.context.new_cdp_session(page)
+            page._mt_cdp = cdp
+        res = await cdp.send("Page.captureSnapshot", {"format": "mhtml"})
+        return ".mhtml", res["data"]
+    except Exception:
+        return ".html", await page.content()
+
+
+async def snapshot_page_html_and_screenshot(
+    page: Page, session_id: str, label: str, ts: str | None = None
+) -> None:
+    _ensure_log_dir()
+    ts = ts or _ts()
+
+    # HTML и скриншот независимы — гоняем оба CDP round-trip'а
+    # параллельно, wall-clock снимка почти вдвое меньше. Скриншот
+    # берём байтами (path=None) в JPEG: для визуальной фиксации шага
+    # quality=70 в ~10 раз меньше full-page PNG, а запись уходит в
+    # тредпул и не стопорит event loop.
+    # return_exceptions: ошибка одного не прячет результат другого.
+    html, shot = await asyncio.gather(
+        _page_html_snapshot(page),
+        page.screenshot(full_page=True, type="jpeg", quality=70),
+        return_exceptions=True,
+    )
+
+    if isinstance(html, Exception):
+        print(f"[SNAPSHOT] Ошибка сохранения HTML: {html}")
+    else:
+        ext, content = html
+        html_path = os.path.join(LOG_DIR, f"page_{session_id}_{label}_{ts}{ext}")
+        try:
+            await asyncio.to_thread(_write_text_file, html_path, content)
+            print(f"[SNAPSHOT] HTML → {html_path}")
+        except Exception as e:
+            print(f"[SNAPSHOT] Ошибка сохранения HTML: {e}")
+
+    if isinstance(shot, Exception):
+        print(f"[SNAPSHOT] Ошибка сохранения скриншота: {shot}")
+    else:
+        jpg_path = os.path.join(LOG_DIR, f"page_{session_id}_{label}_{ts}.jpg")
+        try:
+            await asyncio.to_thread(_write_bytes_file, jpg_path, shot)
+            print(f"[SNAPSHOT] JPG → {jpg_path}")
+        except Exception as e:
+            print(f"[SNAPSHOT] Ошибка сохранения скриншота: {e}")
 
 
 # ------------------------------------------------------------
@@ -511,8 +874,16 @@ async def main():
         context: BrowserContext = await browser.new_context(
             viewport={"width": 1366, "height": 768},
         )
+        # сторонние картинки/шрифты/медиа не качаем вовсе
+        await context.route("**/*", _route_filter)
+
         page: Page = await context.new_page()
 
+        # Снимок window.* компилируется один раз на страницу
+        await page.add_init_script(
+            "window.__snapshotState = " + WINDOW_SNAPSHOT_JS
+        )
+
         attach_console_logger(page, session_id)
         attach_network_logger(page, session_id)
 
@@ -533,23 +904,25 @@ async def main():
 
         try:
             idx = 1
-            loop = asyncio.get_running_loop()
             while True:
                 # ждём Enter в терминале, чтобы сделать “контрольный снимок”
-                await loop.run_in_executor(
-                    None,
-                    lambda: input(
-                        f"[RECORDER] Snapshot #{idx}. Нажми Enter (или Ctrl+C для выхода)... "
-                    ),
+                # (to_thread — современная замена run_in_executor без
+                # лямбды и поиска default executor на каждую итерацию)
+                await asyncio.to_thread(
+                    input,
+                    f"[RECORDER] Snapshot #{idx}. Нажми Enter (или Ctrl+C для выхода)... ",
                 )
 
                 label = f"manual_{idx:03d}"
                 print(f"[RECORDER] Делаю snapshot #{idx} текущего состояния страницы...")
 
-                await snapshot_window_state(page, session_id, label=label)
-                await snapshot_mt_state(page, session_id, label=label)
-                await snapshot_clickable_tree(page, session_id, label=label)
-                await snapshot_page_html_and_screenshot(page, session_id, label=label)
+                # window + MT state + clickable — один CDP round-trip;
+                # таймстемп один на весь проход, файлы коррелируются по суффиксу
+                snap_ts = _ts()
+                await snapshot_combined(page, session_id, label=label, ts=snap_ts)
+                await snapshot_page_html_and_screenshot(
+                    page, session_id, label=label, ts=snap_ts
+                )
 
                 print(f"[RECORDER] Snapshot #{idx} завершён.\n")
                 idx += 1
@@ -11,6 +11,13 @@ from pathlib import Path
 from datetime import datetime
 from playwright.async_api import async_playwright, Page
 
+# orjson — сериализатор на C (сразу в bytes, без промежуточных строк
+# на каждый ключ); без него тихо откатываемся на stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 BASE_DIR = Path("debug/multitransfer_telemetry")
 BASE_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -18,15 +25,38 @@ BASE_DIR.mkdir(parents=True, exist_ok=True)
 TELEMETRY_DURATION_SEC = 300  # 5 минут
 SAMPLING_INTERVAL_SEC = 5     # как часто делаем снапшот storage/window
 
+# Тела крупнее этого не скачиваем из браузера вовсе (по content-length)
+MAX_BODY_BYTES = 256 * 1024
+
+# Сетевые ответы обрабатывает фиксированный пул воркеров через
+# ограниченную очередь: create_task на каждый ответ — это ~2-3 КБ на
+# Task и лавина задач в планировщике на всплеске из 50+ ответов
+NET_QUEUE_SIZE = 1000
+NET_WORKERS = 4
+
 
 def ts() -> str:
     return datetime.utcnow().strftime("%Y%m%d_%H%M%S")
 
 
+def _write_json_sync(obj, path: Path) -> None:
+    if orjson is not None:
+        payload = orjson.dumps(
+            obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        )
+    else:
+        payload = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    # один write() готовых байт вместо сотен мелких кусков,
+    # которые эмитит stdlib-энкодер при записи в текстовый файл
+    with open(path, "wb") as f:
+        f.write(payload)
+
+
 async def save_json(obj, path: Path):
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(obj, f, ensure_ascii=False, indent=2)
+        # запись в тредпуле: блокирующий open/write на event loop
+        # замораживает протокольный насос Playwright на время syscall'а
+        await asyncio.to_thread(_write_json_sync, obj, path)
         print(f"[SAVE] OK → {path}")
     except Exception as e:
         print(f"[SAVE] ERROR {path}: {e}")
@@ -112,10 +142,22 @@ async def collect_network_response(response, storage: list):
         if not any(key in url for key in interesting):
             return
 
+        # Гигантские тела (офферы, HTML-фрагменты) не тянем из браузера:
+        # сначала смотрим content-length, потом берём body() байтами —
+        # одна CDP-передача без лишнего decode/re-encode в драйвере
         try:
-            body = await response.text()
+            clen = int((await response.header_value("content-length")) or 0)
         except Exception:
-            body = "<unreadable>"
+            clen = 0
+
+        if clen > MAX_BODY_BYTES:
+            body = f"<skipped {clen} bytes>"
+        else:
+            try:
+                raw = await response.body()
+                body = raw[:MAX_BODY_BYTES].decode("utf-8", "replace")
+            except Exception:
+                body = "<unreadable>"
 
         item = {
             "url": url,
@@ -203,25 +245,41 @@ async def run():
         page = await context.new_page()
 
         # --- LOG FILE ---
+        # большой буфер вместо flush() на каждую строку: ядро получает
+        # запись пачками по 64 КБ, а close() в конце доливает хвост
         console_log_path = BASE_DIR / f"console_{ts()}.log"
-        console_f = open(console_log_path, "w", encoding="utf-8")
+        console_f = open(console_log_path, "w", encoding="utf-8", buffering=1 << 16)
 
         def _on_console(msg):
             line = f"{datetime.utcnow().isoformat()} [{msg.type.upper()}] {msg.text}\n"
             console_f.write(line)
-            console_f.flush()
 
         page.on("console", _on_console)
 
         # --- NETWORK CAPTURE ---
         network_data = []
+        net_queue: asyncio.Queue = asyncio.Queue(maxsize=NET_QUEUE_SIZE)
+
+        async def _net_worker():
+            while True:
+                resp = await net_queue.get()
+                try:
+                    await collect_network_response(resp, network_data)
+                finally:
+                    net_queue.task_done()
+
+        net_workers = [
+            asyncio.create_task(_net_worker()) for _ in range(NET_WORKERS)
+        ]
 
-        context.on(
-            "response",
-            lambda resp: asyncio.create_task(
-                collect_network_response(resp, network_data)
-            ),
-        )
+        def _on_response(resp):
+            # при переполнении дропаем, а не раздуваем планировщик
+            try:
+                net_queue.put_nowait(resp)
+            except asyncio.QueueFull:
+                print(f"[NETWORK] очередь переполнена, дропаю {resp.url}")
+
+        context.on("response", _on_response)
 
         # --- Навигация + автоснапшоты на каждом переходе ---
         await navigation_sniffer(page)
@@ -257,6 +315,15 @@ async def run():
         except asyncio.CancelledError:
             pass
 
+        # Даём воркерам дообработать хвост очереди, потом гасим их —
+        # иначе последние ответы не попадут в финальный дамп
+        try:
+            await asyncio.wait_for(net_queue.join(), timeout=30)
+        except asyncio.TimeoutError:
+            print(f"[NETWORK] не дождался очереди, осталось {net_queue.qsize()}")
+        for w in net_workers:
+            w.cancel()
+
         # Финальный дамп network
         await save_json(network_data, BASE_DIR / f"network_{ts()}.json")
 